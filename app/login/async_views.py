@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+""" Async versions of the login and register views for ASGI deployments (Django >= 3.1),
+enabled with YOLO_ASYNC_VIEWS.
+
+Django reads the whole request body before the view runs, so uploads are not
+streamed; the form is parsed and the upload converted in a worker thread, then
+appended to redis a chunk at a time. Results are awaited on an asyncio redis client,
+so a waiting login holds no thread.
+"""
+from __future__ import unicode_literals
+import json
+import uuid
+from datetime import datetime
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+from login import queues
+from login.audio import StreamingWavNormalizer
+from login.models import Person
+from login.views import myconverter, _busy, _name_taken, _start_session
+
+_redis_conn = None
+
+
+def get_redis_conn():
+    global _redis_conn
+    if _redis_conn is None:
+        _redis_conn = redis.asyncio.Redis(host='localhost', port=6379)
+    return _redis_conn
+
+
+def _form(request):
+    """ Parse the request body, which reads any upload spooled to disk """
+    return request.POST, request.FILES
+
+
+def _convert_next(chunks, normalizer):
+    """ :return: framed bytes of the next upload chunk, b'' when there are none yet and
+    None once the upload is exhausted """
+    chunk = next(chunks, None)
+    if chunk is None:
+        normalizer.close()
+        return None
+    return normalizer.feed(chunk)
+
+
+async def _store_upload(conn, upload, request_id):
+    """ Append the upload to audio:{request_id} as framed mono int16, one chunk at a time """
+    key = 'audio:{}'.format(request_id)
+    normalizer = StreamingWavNormalizer()
+    chunks = upload.chunks()
+    stored = False
+    try:
+        while True:
+            data = await sync_to_async(_convert_next)(chunks, normalizer)
+            if data is None:
+                break
+            if not data:
+                continue
+            await conn.append(key, data)
+            if not stored:
+                # Expire uploads that never make it into the queue
+                await conn.expire(key, settings.YOLO_AUDIO_TTL)
+                stored = True
+    except Exception:
+        await conn.delete(key)
+        raise
+
+
+@csrf_exempt
+async def login(request):
+    if request.method == "POST":
+        post, files = await sync_to_async(_form)(request)
+        text = post['text']
+
+        conn = get_redis_conn()
+        redis_request = {
+            "id": uuid.uuid4().hex,
+            "timestamp": datetime.now(),
+            "type": "authenticate",
+            "prompt": text
+        }
+
+        await _store_upload(conn, files['picture'], redis_request['id'])
+        if await queues.enqueue_stored(conn, redis_request, default=myconverter) != queues.QUEUED:
+            return _busy()
+
+        # Wait for the result, the processor answers expired requests with a timeout
+        result = await queues.await_result(conn, redis_request['id'], queues.deadline_for('authenticate') + 1)
+        if result is None:
+            result = {'username': None, 'error': 'timeout'}
+
+        if result['username']:
+            await sync_to_async(_start_session)(request, result['username'].strip())
+        else:
+            result['username'] = 'None'
+
+        response = {
+            "username": result["username"].strip()
+        }
+
+        return HttpResponse(json.dumps(response), content_type='application/json')
+
+    return render(request, 'login/home.html', {})
+
+
+@csrf_exempt
+async def register(request):
+    if request.method == "POST":
+        conn = get_redis_conn()
+        post, files = await sync_to_async(_form)(request)
+        name = post.get('name')
+        # Reject known names before reading the upload
+        if name is not None and await conn.sismember(queues.USERNAMES, name):
+            return _name_taken()
+
+        redis_request = {
+            "id": uuid.uuid4().hex,
+            "name": name,
+            "timestamp": datetime.now(),
+            "type": "register"
+        }
+
+        await _store_upload(conn, files['picture'], redis_request['id'])
+        status = await queues.enqueue_stored(conn, redis_request, default=myconverter)
+        if status == queues.NAME_TAKEN:
+            return _name_taken()
+        if status == queues.FULL:
+            return _busy()
+
+        if name is not None:
+            await sync_to_async(Person.objects.get_or_create)(username=name)
+        return render(request, 'login/home.html', {})
+
+    return render(request, 'login/register.html', {})
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import struct
+from functools import lru_cache
+from math import gcd
+from io import BytesIO
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import firwin, resample_poly
+
+# Must match processor/audio_format.py (checked by processor/test_audio_format.py)
+MAGIC = b'YAUD'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+
+
+def stream_header(sample_rate):
+    """ Frame header for mono int16 samples at sample_rate whose count is not known yet """
+    return HEADER.pack(MAGIC, FORMAT_VERSION, 1, sample_rate, 0)
+
+
+@lru_cache(maxsize=None)
+def _polyphase_filter(source_rate, sample_rate):
+    """ The anti-aliasing filter resample_poly would design for this pair of rates,
+    designed once (as data/processing/resample.py does for the processor, checked by
+    processor/test_audio_format.py) """
+    g = gcd(source_rate, sample_rate)
+    up, down = sample_rate // g, source_rate // g
+    max_rate = max(up, down)
+    taps = firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    taps.setflags(write=False)
+    return up, down, taps
+
+
+def _to_float(data):
+    """ Scale PCM samples of any wav sample type to [-1, 1) """
+    if data.dtype == np.uint8:
+        return (data.astype(np.float64) - 128) / 128.0
+    if np.issubdtype(data.dtype, np.integer):
+        return data / float(2 ** (8 * data.dtype.itemsize - 1))
+    return data.astype(np.float64)
+
+
+def normalize_upload(wav_bytes, sample_rate):
+    """ Decode an uploaded wav file once into mono int16 at sample_rate, framed with
+    the header the processor reads
+
+    The first channel is kept, as the processor did when it decoded uploads itself.
+    """
+    source_rate, data = wavfile.read(BytesIO(wav_bytes))
+    if data.ndim > 1:
+        data = data[:, 0]
+    data = _to_float(data)
+
+    if source_rate != sample_rate:
+        up, down, taps = _polyphase_filter(source_rate, sample_rate)
+        data = resample_poly(data, up, down, window=taps)
+
+    samples = np.clip(np.round(data * 32768.0), -32768, 32767).astype('<i2')
+    return HEADER.pack(MAGIC, FORMAT_VERSION, 1, sample_rate, len(samples)) + samples.tobytes()
+
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+_RIFF_HEADER = struct.Struct('<4sI4s')
+_CHUNK_HEADER = struct.Struct('<4sI')
+_FMT = struct.Struct('<HHIIHH')
+
+
+class StreamingWavNormalizer(object):
+    """ Converts a wav file fed in arbitrary chunks to framed mono int16 at the source
+    sample rate, without holding the whole file
+
+    The frame header is written with n_samples = 0 (length taken from the buffer), since
+    the length is not known up front. Resampling to the canonical rate is left to the
+    processor, as it needs the whole signal.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._header_done = False
+        self._fmt = None
+        self._data_remaining = None
+        self._skip = 0
+
+    def _parse_fmt(self, chunk):
+        format_tag, channels, sample_rate, _, block_align, bits = _FMT.unpack_from(chunk)
+        if format_tag == WAVE_FORMAT_EXTENSIBLE and len(chunk) >= 26:
+            format_tag, = struct.unpack_from('<H', chunk, 24)
+        if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise ValueError("Unsupported wav encoding {}".format(format_tag))
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT and bits != 32:
+            raise ValueError("Unsupported float wav sample size {}".format(bits))
+        self._fmt = (format_tag, channels, sample_rate, block_align, bits // 8)
+
+    def _convert(self, frames):
+        """ First channel of whole frames as int16 """
+        format_tag, channels, _, block_align, width = self._fmt
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, block_align)[:, :width]
+        if format_tag == WAVE_FORMAT_IEEE_FLOAT:
+            data = np.ascontiguousarray(raw).view('<f4').reshape(-1)
+            return np.clip(np.round(data * 32768.0), -32768, 32767).astype('<i2')
+        if width == 1:
+            return ((raw[:, 0].astype(np.int16) - 128) << 8).astype('<i2')
+        # Keep the two most significant bytes of little-endian PCM
+        return np.ascontiguousarray(raw[:, width - 2:]).view('<i2').reshape(-1)
+
+    def feed(self, chunk):
+        """ :return: framed bytes to append to what was returned so far """
+        self._buffer.extend(chunk)
+        out = []
+
+        while True:
+            if not self._header_done:
+                if len(self._buffer) < _RIFF_HEADER.size:
+                    break
+                riff, _, wave = _RIFF_HEADER.unpack_from(self._buffer)
+                if riff != b'RIFF' or wave != b'WAVE':
+                    raise ValueError("Not a wav file")
+                del self._buffer[:_RIFF_HEADER.size]
+                self._header_done = True
+            elif self._skip:
+                n = min(self._skip, len(self._buffer))
+                del self._buffer[:n]
+                self._skip -= n
+                if self._skip:
+                    break
+            elif self._data_remaining is None:
+                if len(self._buffer) < _CHUNK_HEADER.size:
+                    break
+                chunk_id, size = _CHUNK_HEADER.unpack_from(self._buffer)
+                if chunk_id == b'fmt ':
+                    if len(self._buffer) < _CHUNK_HEADER.size + size:
+                        break
+                    self._parse_fmt(bytes(self._buffer[_CHUNK_HEADER.size:_CHUNK_HEADER.size + size]))
+                    del self._buffer[:_CHUNK_HEADER.size + size + size % 2]
+                elif chunk_id == b'data':
+                    if self._fmt is None:
+                        raise ValueError("wav data before format chunk")
+                    del self._buffer[:_CHUNK_HEADER.size]
+                    # Recorders that stream their output leave the size at 0 or 0xFFFFFFFF
+                    self._data_remaining = size if 0 < size < 0xFFFFFFFF else float('inf')
+                    out.append(stream_header(self._fmt[2]))
+                else:
+                    del self._buffer[:_CHUNK_HEADER.size]
+                    self._skip = size + size % 2
+            else:
+                block_align = self._fmt[3]
+                n = int(min(len(self._buffer), self._data_remaining))
+                n -= n % block_align
+                if n == 0:
+                    break
+                out.append(self._convert(bytes(self._buffer[:n])).tobytes())
+                del self._buffer[:n]
+                self._data_remaining -= n
+                if self._data_remaining < block_align:
+                    # Trailing chunks after the samples are of no interest
+                    self._skip = float('inf')
+
+        return b''.join(out)
+
+    def close(self):
+        if self._data_remaining is None:
+            raise ValueError("wav file has no data chunk")
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def remove_duplicate_usernames(apps, schema_editor):
+    """ Keep the earliest Person of each username so the unique index can be built """
+    Person = apps.get_model('login', 'Person')
+    seen = set()
+    duplicates = []
+    for pk, username in Person.objects.order_by('id').values_list('id', 'username'):
+        if username in seen:
+            duplicates.append(pk)
+        seen.add(username)
+    Person.objects.filter(pk__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('login', '0004_auto_20190317_1838'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='person',
+            old_name='name',
+            new_name='username',
+        ),
+        migrations.RemoveField(
+            model_name='person',
+            name='recording',
+        ),
+        migrations.RunPython(remove_duplicate_usernames, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='person',
+            name='username',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
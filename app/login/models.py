@@ -8,5 +8,5 @@ from django.contrib.auth.models import User
 # Create your models here.
 
 class Person(models.Model):
-	username = models.CharField(max_length = 255)
+	username = models.CharField(max_length = 255, unique = True)
 
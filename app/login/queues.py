@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+import time
+from django.conf import settings
+
+# Must match processor/queues.py
+LANES = {
+    'authenticate': 'queue:requests:authenticate',
+    'register': 'queue:requests:register',
+}
+STREAM_LANE = 'queue:requests:stream'
+# Pushed instead of the empty end item when the client gives up on a stream. Audio
+# pieces are whole int16 samples, so an odd length marks it apart from them.
+STREAM_ABORT = b'abort'
+
+# Set of every registered or pending username, shared with the processor which fills
+# it from its database on startup. Claiming a name with SADD is the one duplicate check.
+USERNAMES = 'usernames'
+
+# enqueue results
+QUEUED = 1
+FULL = 0
+NAME_TAKEN = -1
+
+# Unless lane KEYS[1] already holds ARGV[2] requests or the username ARGV[5] (if any)
+# is already in set KEYS[3], claim the name, store audio ARGV[3] at KEYS[2] with a
+# TTL of ARGV[4] seconds and push request ARGV[1], all in one round trip. The audio is
+# always stored before the request becomes visible to the processor.
+_ADMIT = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+if ARGV[5] ~= '' and redis.call('SADD', KEYS[3], ARGV[5]) == 0 then
+    return -1
+end
+redis.call('SET', KEYS[2], ARGV[3], 'EX', ARGV[4])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+# As _ADMIT for audio already streamed into KEYS[2], which is dropped unless queued.
+# ARGV: request, maximum depth, audio TTL, username
+_ADMIT_STORED = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    redis.call('DEL', KEYS[2])
+    return 0
+end
+if ARGV[4] ~= '' and redis.call('SADD', KEYS[3], ARGV[4]) == 0 then
+    redis.call('DEL', KEYS[2])
+    return -1
+end
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Unless lane KEYS[1] already holds ARGV[2] requests, start the audio stream KEYS[2]
+# with frame header ARGV[3] and a TTL of ARGV[4] seconds and push request ARGV[1]
+_ADMIT_STREAM = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+return 1
+"""
+
+# Count ARGV[1] against the byte total KEYS[2] of stream KEYS[1] and push it unless
+# that makes more than ARGV[2] bytes. Both keys expire after ARGV[3] seconds.
+_APPEND_STREAM = """
+local total = redis.call('INCRBY', KEYS[2], string.len(ARGV[1]))
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+if total > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+_admit = None
+_admit_stored = None
+_admit_stream = None
+_append_stream = None
+
+
+def deadline_for(request_type):
+    return settings.YOLO_REQUEST_DEADLINE[request_type]
+
+
+def username_taken(conn, name):
+    """ Cheap early check; only the claim made by enqueue is authoritative """
+    return bool(conn.sismember(USERNAMES, name))
+
+
+def enqueue(conn, request, audio_bytes, default=None):
+    """ Stamp request with its deadline, then store its audio and push it onto its lane
+    if there is room. Registrations also claim their username.
+
+    :return: QUEUED, FULL or NAME_TAKEN
+    """
+    global _admit
+    if _admit is None:
+        _admit = conn.register_script(_ADMIT)
+
+    request_type = request['type']
+    request['deadline'] = time.time() + deadline_for(request_type)
+    status = _admit(keys=[LANES[request_type], 'audio:{}'.format(request['id']), USERNAMES],
+                    args=[json.dumps(request, default=default), settings.YOLO_MAX_QUEUE_DEPTH[request_type],
+                          audio_bytes, settings.YOLO_AUDIO_TTL, request.get('name') or ''],
+                    client=conn)
+    return int(status)
+
+
+def stream_key(request_id):
+    return 'stream:{}'.format(request_id)
+
+
+def stream_bytes_key(request_id):
+    return 'stream:{}:bytes'.format(request_id)
+
+
+def open_stream(conn, request, header, default=None):
+    """ Queue a streamed request on the stream lane before its audio, which the
+    processor reads from stream:{id} while append_stream adds to it
+
+    :param header: frame header of the audio to come
+    :return: QUEUED or FULL
+
+    The deadline leaves room for a whole stream, since the request may wait in the lane
+    behind users who are still speaking.
+    """
+    global _admit_stream
+    if _admit_stream is None:
+        _admit_stream = conn.register_script(_ADMIT_STREAM)
+
+    request['stream'] = True
+    request['deadline'] = time.time() + settings.YOLO_STREAM_MAX_SECONDS + deadline_for(request['type'])
+    status = _admit_stream(keys=[STREAM_LANE, stream_key(request['id'])],
+                           args=[json.dumps(request, default=default), settings.YOLO_MAX_QUEUE_DEPTH['stream'],
+                                 header, settings.YOLO_AUDIO_TTL],
+                           client=conn)
+    return int(status)
+
+
+def append_stream(conn, request_id, data):
+    """ Push the next piece of a streamed request's audio
+
+    :return: False if the stream would exceed YOLO_STREAM_MAX_BYTES, in which case the
+        piece is dropped
+    """
+    global _append_stream
+    if _append_stream is None:
+        _append_stream = conn.register_script(_APPEND_STREAM)
+    if not data:
+        # An empty item ends the stream
+        return True
+    return bool(_append_stream(keys=[stream_key(request_id), stream_bytes_key(request_id)],
+                               args=[data, settings.YOLO_STREAM_MAX_BYTES, settings.YOLO_AUDIO_TTL],
+                               client=conn))
+
+
+def close_stream(conn, request_id, abort=False):
+    """ End a stream, or with abort, tell the processor to drop it without answering """
+    # May come after the processor has answered and dropped the stream
+    pipe = conn.pipeline()
+    pipe.rpush(stream_key(request_id), STREAM_ABORT if abort else b'')
+    pipe.expire(stream_key(request_id), settings.YOLO_AUDIO_TTL)
+    pipe.execute()
+
+
+def wait_for_result(conn, request_id, timeout, poll_interval=0.1):
+    """ :return: the decoded result for request_id, or None if none arrived within timeout """
+    key = 'result:{}'.format(request_id)
+    give_up = time.time() + timeout
+    val = conn.get(key)
+    while val is None:
+        if time.time() > give_up:
+            return None
+        time.sleep(poll_interval)
+        val = conn.get(key)
+    conn.delete(key)
+    return json.loads(val.decode('utf-8'))
+
+
+async def enqueue_stored(conn, request, default=None):
+    """ enqueue for a request whose audio is already at audio:{id}, on an asyncio client
+
+    :return: QUEUED, FULL or NAME_TAKEN
+    """
+    global _admit_stored
+    if _admit_stored is None:
+        _admit_stored = conn.register_script(_ADMIT_STORED)
+
+    request_type = request['type']
+    request['deadline'] = time.time() + deadline_for(request_type)
+    status = await _admit_stored(keys=[LANES[request_type], 'audio:{}'.format(request['id']), USERNAMES],
+                                 args=[json.dumps(request, default=default),
+                                       settings.YOLO_MAX_QUEUE_DEPTH[request_type], settings.YOLO_AUDIO_TTL,
+                                       request.get('name') or ''],
+                                 client=conn)
+    return int(status)
+
+
+async def await_result(conn, request_id, timeout):
+    """ wait_for_result on an asyncio client, without holding a thread while waiting
+
+    The processor publishes on result:{id} once the result is written, so this
+    subscribes before the first read and sleeps on the channel instead of polling.
+    """
+    key = 'result:{}'.format(request_id)
+    give_up = time.time() + timeout
+    pubsub = conn.pubsub()
+    await pubsub.subscribe(key)
+    try:
+        val = await conn.get(key)
+        while val is None:
+            remaining = give_up - time.time()
+            if remaining <= 0:
+                return None
+            if await pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining) is not None:
+                val = await conn.get(key)
+    finally:
+        await pubsub.reset()
+    await conn.delete(key)
+    return json.loads(val.decode('utf-8'))
@@ -1,10 +1,20 @@
+from django.conf import settings
 from django.conf.urls import include, url
 from django.contrib.auth import views as auth_views
 from . import views
 
+if settings.YOLO_ASYNC_VIEWS:
+    from . import async_views as upload_views
+else:
+    upload_views = views
+
 urlpatterns = [
-    url(r'^login$', views.login, name='login'),
-    url(r'^register$', views.register, name="register"),
+    url(r'^login$', upload_views.login, name='login'),
+    url(r'^login/stream$', views.login_stream, name='login_stream'),
+    url(r'^login/stream/(?P<stream_id>[0-9a-f]{32})$', views.login_stream_chunk, name='login_stream_chunk'),
+    url(r'^login/stream/(?P<stream_id>[0-9a-f]{32})/end$', views.login_stream_end, name='login_stream_end'),
+    url(r'^login/stream/(?P<stream_id>[0-9a-f]{32})/abort$', views.login_stream_abort, name='login_stream_abort'),
+    url(r'^register$', upload_views.register, name="register"),
     url(r'^welcome/(?P<name>[\w\-]+)$', views.loggedIn, name="loggedIn"),
     url(r'^error$', views.error, name="error"),
 ]
@@ -1,19 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 from django.contrib.auth.models import User
-from django.contrib.auth import authenticate
+from django.contrib.auth import login as auth_login
+from django.contrib.auth.hashers import make_password
 from django.shortcuts import render
 from django.views.decorators.csrf import ensure_csrf_cookie
 from login.models import Person
+from login import queues
+from login.audio import normalize_upload, stream_header
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
 import asyncio
 from django.contrib import messages
 from django.http import HttpResponseRedirect
-from django.http import HttpResponse
-from django.shortcuts import render_to_response
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
 from django.shortcuts import redirect
 import redis
 import hashlib
+import uuid
 from datetime import datetime
 import json
 import time
@@ -27,12 +31,45 @@ def get_redis_conn():
    return _redis_conn
 
 
-def _fetch(key, conn):
-    val = conn.get(key)
-    while val is None:
-        time.sleep(0.1)
-        val = conn.get(key)
-    return val
+def _busy():
+    # The pages only handle successful responses, so report the rejection in the body
+    response = {
+        "username": "None",
+        "error": "The server is busy. Try again in a moment!"
+    }
+    return HttpResponse(json.dumps(response), content_type='application/json')
+
+
+def _name_taken():
+    message = 'Username already exists. Try again with valid name!'
+    json_error = '{ "error": "'+message+'" }'
+    return HttpResponse(json_error, content_type='application/json')
+
+
+def _start_session(request, username):
+    """ Log the session in as the Django user for a speaker the processor identified.
+    The user is created on first login with an unusable password, so no password is
+    ever hashed or checked. """
+    user, _ = User.objects.get_or_create(username=username,
+                                         defaults={'email': 'user@gmail.com', 'password': make_password(None)})
+    auth_login(request, user, backend='django.contrib.auth.backends.ModelBackend')
+
+
+def _login_response(request, result):
+    """ Start a session for the user the processor identified, if any, and report it """
+    if result is None:
+        result = {'username': None, 'error': 'timeout'}
+
+    if result['username']:
+        _start_session(request, result['username'].strip())
+    else:
+        result['username'] = 'None'
+
+    response = {
+        "username": result["username"].strip()
+    }
+
+    return HttpResponse(json.dumps(response), content_type='application/json')
 
 
 def myconverter(o):
@@ -56,14 +93,13 @@ def hash_blob(blob):
 # Create your views here.
 @csrf_exempt
 def login(request):
-    User.objects.all().delete()
     print('in events')
     print(request.method)
     if request.method == "POST":
         text = request.POST['text']
 
         conn = get_redis_conn()
-        audio_bytes = request.FILES['picture'].read()
+        audio_bytes = normalize_upload(request.FILES['picture'].read(), settings.YOLO_AUDIO_SAMPLE_RATE)
 
         redis_request = {
             "id": get_unique_id(audio_bytes),
@@ -72,30 +108,95 @@ def login(request):
             "prompt": text
         }
 
-        conn.set('audio:{}'.format(redis_request['id']), audio_bytes)
-        time.sleep(0.1)
-        conn.rpush('queue:requests', json.dumps(redis_request, default=myconverter))
+        if queues.enqueue(conn, redis_request, audio_bytes, default=myconverter) != queues.QUEUED:
+            return _busy()
 
-        # Wait for the result
-        result = _fetch('result:{}'.format(redis_request['id']), conn)
-        result = json.loads(result.decode('utf-8'))
+        # Wait for the result, the processor answers expired requests with a timeout
+        result = queues.wait_for_result(conn, redis_request['id'], queues.deadline_for('authenticate') + 1)
+        return _login_response(request, result)
 
+    print('GET request made')
+    return render(request, 'login/home.html', {})
 
-        print(result)
-        if result['username']:
-            user = User.objects.create_user(result['username'].strip(), 'user@gmail.com', 'yolorrn')
-            user.save()
-        else:
-            result['username'] = 'None'
 
-        response = {
-            "username": result["username"].strip()
-        }
+# Streamed login: the client POSTs the prompt and its sample rate to login_stream when
+# recording starts, then each piece of little-endian int16 mono samples to
+# login_stream_chunk as it is recorded, and finally calls login_stream_end for the result,
+# or login_stream_abort if it falls back to uploading the recording.
+# The processor featurizes the pieces as they arrive.
 
-        return HttpResponse(json.dumps(response), content_type='application/json')
+@csrf_exempt
+def login_stream(request):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        sample_rate = int(request.POST['sample_rate'])
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest()
+    if not 8000 <= sample_rate <= 192000:
+        return HttpResponseBadRequest()
+
+    redis_request = {
+        "id": uuid.uuid4().hex,
+        "timestamp": datetime.now(),
+        "type": "authenticate",
+        "prompt": request.POST['text']
+    }
+
+    if queues.open_stream(get_redis_conn(), redis_request, stream_header(sample_rate),
+                          default=myconverter) != queues.QUEUED:
+        return _busy()
+
+    # Only the session that started a stream may add to it
+    request.session['login_stream'] = redis_request['id']
+    request.session['login_stream_started'] = time.time()
+    return HttpResponse(json.dumps({"id": redis_request['id']}), content_type='application/json')
 
-    print('GET request made')
-    return render(request, 'login/home.html', {})
+
+@csrf_exempt
+def login_stream_chunk(request, stream_id):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    if request.session.get('login_stream') != stream_id or len(request.body) % 2:
+        return HttpResponseBadRequest()
+
+    conn = get_redis_conn()
+    too_long = time.time() - request.session['login_stream_started'] > settings.YOLO_STREAM_MAX_SECONDS
+    if too_long or not queues.append_stream(conn, stream_id, request.body):
+        # Let the processor finish with the audio so far, the client ends the stream
+        # as usual to collect the result
+        queues.close_stream(conn, stream_id)
+        return HttpResponse(status=413)
+    return HttpResponse(status=204)
+
+
+@csrf_exempt
+def login_stream_end(request, stream_id):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    if request.session.get('login_stream') != stream_id:
+        return HttpResponseBadRequest()
+    del request.session['login_stream']
+    request.session.pop('login_stream_started', None)
+
+    conn = get_redis_conn()
+    queues.close_stream(conn, stream_id)
+    result = queues.wait_for_result(conn, stream_id, queues.deadline_for('authenticate') + 1)
+    return _login_response(request, result)
+
+
+@csrf_exempt
+def login_stream_abort(request, stream_id):
+    """ The client fell back to uploading its recording, release the stream's worker """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+    if request.session.get('login_stream') != stream_id:
+        return HttpResponseBadRequest()
+    del request.session['login_stream']
+    request.session.pop('login_stream_started', None)
+
+    queues.close_stream(get_redis_conn(), stream_id, abort=True)
+    return HttpResponse(status=204)
 
 
 @csrf_exempt
@@ -104,9 +205,9 @@ def loggedIn(request, name):
         #json_context = '{ "username": "'+ name + '" }'
         #return HttpResponse(json_context, content_type='application/json')
 
-        user = authenticate(request, username=name, password='yolorrn')
-        if user is not None:
+        if request.user.is_authenticated and request.user.username == name:
             return render(request, 'login/welcome.html')
+        return redirect('error')
 
 @csrf_exempt
 def error(request):
@@ -116,28 +217,29 @@ def error(request):
 @csrf_exempt
 def register(request):
     if request.method == "POST":
-        if 'name' in request.POST:
-            name = request.POST['name']
-            if not Person.objects.filter(username=name).exists():
-                person = Person(username=name)
-                person.save()
-            else:
-                message = 'Username already exists. Try again with valid name!'
-                json_error = '{ "error": "'+message+'" }'
-                return HttpResponse(json_error, content_type='application/json')
-
         conn = get_redis_conn()
-        audio_bytes = request.FILES['picture'].read()
+        name = request.POST.get('name')
+        # Reject known names before decoding the upload
+        if name is not None and queues.username_taken(conn, name):
+            return _name_taken()
+
+        audio_bytes = normalize_upload(request.FILES['picture'].read(), settings.YOLO_AUDIO_SAMPLE_RATE)
 
         redis_request = {
             "id": get_unique_id(audio_bytes),
-            "name": request.POST.get('name'),
+            "name": name,
             "timestamp": datetime.now(),
             "type": "register"
         }
 
-        conn.set('audio:{}'.format(redis_request['id']), audio_bytes)
-        conn.rpush('queue:requests', json.dumps(redis_request, default=myconverter))
+        status = queues.enqueue(conn, redis_request, audio_bytes, default=myconverter)
+        if status == queues.NAME_TAKEN:
+            return _name_taken()
+        if status == queues.FULL:
+            return _busy()
+
+        if name is not None:
+            Person.objects.get_or_create(username=name)
         return render(request, 'login/home.html', {})
         
     return render(request, 'login/register.html', {})
@@ -0,0 +1,15 @@
+"""
+ASGI config for webapps project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with an ASGI server (e.g. ``uvicorn webapps.asgi:application``) and set
+YOLO_ASYNC_VIEWS to route login and register to login.async_views.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "webapps.settings")
+
+application = get_asgi_application()
@@ -119,3 +119,39 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Processor request queue
+# Requests beyond the maximum depth of their lane are rejected instead of queued
+
+YOLO_MAX_QUEUE_DEPTH = {
+    'authenticate': 50,
+    'register': 20,
+    'stream': 10,
+}
+
+# Seconds after enqueue at which the processor drops a request with a timeout result
+
+YOLO_REQUEST_DEADLINE = {
+    'authenticate': 10,
+    'register': 300,
+}
+
+# Seconds before uploaded audio that was never processed expires from redis
+
+YOLO_AUDIO_TTL = 600
+
+# Uploads are stored for the processor as mono int16 at this rate
+
+YOLO_AUDIO_SAMPLE_RATE = 16000
+
+# Longest (seconds since it was opened) and largest (bytes of audio) a streamed login
+# may be. Must match RequestQueue.max_stream_* in the processor config
+
+YOLO_STREAM_MAX_SECONDS = 30
+YOLO_STREAM_MAX_BYTES = 4 * 1024 * 1024
+
+# Serve login and register from login.async_views (requires Django >= 3.1 behind
+# webapps.asgi)
+
+YOLO_ASYNC_VIEWS = False
@@ -7,6 +7,7 @@ import ray
 import speechpy
 from datetime import datetime
 import pickle as pkl
+from data.processing.resample import resample, TARGET_SAMPLE_RATE
 
 ## VAD Parameters ##
 VAD_THRESHOLD = -80     # if a frame has no filter that exceeds this threshold, it is assumed silent and removed
@@ -27,6 +28,7 @@ def normalize(utterance):
 
 def procces_wav(wav_path):
     fs, signal = wav.read(wav_path)
+    signal, fs = resample(signal, fs), TARGET_SAMPLE_RATE
     spect = speechpy.feature.lmfe(signal, sampling_frequency=fs, num_filters=64)
     return spect
 
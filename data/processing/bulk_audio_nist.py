@@ -6,20 +6,22 @@ import argparse
 import time
 import ray
 import scipy.signal
+from data.processing.resample import resample, TARGET_SAMPLE_RATE
 
 @ray.remote
-def process_with_mel(wav_path, out_path, target_sr=None):
-    data, sr = librosa.load(wav_path)
-    if target_sr and target_sr != sr:
-        librosa.resample(data, orig_sr=sr, target_sr=target_sr)
+def process_with_mel(wav_path, out_path, target_sr=TARGET_SAMPLE_RATE):
+    data, sr = librosa.load(wav_path, sr=None)
+    if target_sr:
+        data, sr = resample(data, sr, target_sr), target_sr
     mel = librosa.feature.melspectrogram(y=data, sr=sr, n_fft=2048, n_mels=64)
     assert mel.shape[0] == 64
     np.save(out_path, mel)
 
 @ray.remote
-def process_with_stft(wav_path, out_path, target_sr=16000):
-    data, sr = librosa.load(wav_path)
-    data = librosa.resample(data, orig_sr=sr, target_sr=target_sr)
+def process_with_stft(wav_path, out_path, target_sr=TARGET_SAMPLE_RATE):
+    # Loaded at the file's own rate so that it is resampled only once
+    data, sr = librosa.load(wav_path, sr=None)
+    data = resample(data, sr, target_sr)
     spect = librosa.stft(y=data, n_fft=1024, win_length=400, hop_length=160)
     spect = np.abs(spect)
     np.save(out_path, spect)
@@ -32,7 +34,7 @@ if __name__ == "__main__":
                         default='/home/rbrigden/nist-sre/raw/wav')
     parser.add_argument("--dest", type=str,
                         default='/home/rbrigden/nist-sre/raw/processed')
-    parser.add_argument("--sample-rate", type=int, default=None)
+    parser.add_argument("--sample-rate", type=int, default=TARGET_SAMPLE_RATE)
     
     args = parser.parse_args()
 
@@ -0,0 +1,35 @@
+""" Polyphase resampling to one fixed rate, shared by the processor and the offline
+feature scripts so that features are always computed at the rate the models were
+trained on.
+
+scipy.signal.resample_poly designs its anti-aliasing filter on every call, which for
+44.1 kHz -> 16 kHz is a kaiser windowed sinc of several thousand taps. The design only
+depends on the pair of rates, so it is done once per pair here and passed back to
+resample_poly, giving the same output.
+"""
+from functools import lru_cache
+from math import gcd
+import numpy as np
+import scipy.signal
+
+TARGET_SAMPLE_RATE = 16000
+
+
+@lru_cache(maxsize=None)
+def polyphase_filter(source_rate, target_rate):
+    """ :return: (up, down, filter taps) as resample_poly would design them """
+    g = gcd(source_rate, target_rate)
+    up, down = target_rate // g, source_rate // g
+    max_rate = max(up, down)
+    taps = scipy.signal.firwin(2 * 10 * max_rate + 1, 1.0 / max_rate, window=('kaiser', 5.0))
+    taps.setflags(write=False)
+    return up, down, taps
+
+
+def resample(data, source_rate, target_rate=TARGET_SAMPLE_RATE):
+    """ :param data: 1-d signal at source_rate
+    :return: data at target_rate, or data itself if the rates match """
+    if source_rate == target_rate:
+        return data
+    up, down, taps = polyphase_filter(source_rate, target_rate)
+    return scipy.signal.resample_poly(np.asarray(data, dtype=np.float64), up, down, window=taps)
@@ -88,15 +88,22 @@ if __name__ == '__main__':
     parser.add_argument("--stats-path", type=str,
                         default='stats.npy',
                         help='stats to normalize the data with')
+    parser.add_argument("--embedding-server", type=str,
+                        default=None,
+                        help='unix socket of a running processor.embedding_server to embed with')
 
     args = parser.parse_args()
     source_path = args.source
     names = os.listdir(source_path)
     file_paths = [os.path.join(source_path, name) for name in names]
 
-    model = models.IdentifyAndEmbed(1200).cuda()
-    inference = SpeakerEmbedInference(model)
-    inference.load_params(args.param_path)
+    if args.embedding_server:
+        from processor.embedding_server import RemoteSpeakerEmbeddingProcessor
+        inference = RemoteSpeakerEmbeddingProcessor(args.embedding_server)
+    else:
+        model = models.IdentifyAndEmbed(1200).cuda()
+        inference = SpeakerEmbedInference(model)
+        inference.load_params(args.param_path)
 
     dset = WavDataset(file_paths, get_label=get_label)
     if args.stats_path:
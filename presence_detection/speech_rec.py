@@ -49,7 +49,14 @@ def audio_to_input_vector(audio, fs, numcep, numcontext):
     """
     # Get mfcc coefficients
     features = mfcc(audio, samplerate=fs, numcep=numcep)
+    return features_to_input_vector(features, numcep, numcontext)
 
+
+def features_to_input_vector(features, numcep, numcontext):
+    r"""
+    As audio_to_input_vector, for ``numcep`` MFCC features at every 0.01s time step
+    that were computed elsewhere.
+    """
     # We only keep every second feature (BiRNN stride = 2)
     features = features[::2]
 
@@ -172,7 +179,9 @@ class SpeechRec:
             graph_def.ParseFromString(f.read())
         self.graph_def = graph_def
 
-    def forward(self, audio, fs, display_chars=False):
+    def forward(self, audio, fs, display_chars=False, features=None, cancel=None):
+        """ :param features: MFCCs of audio to use instead of computing them
+        :param cancel: threading.Event; once set the remaining steps are not run """
 
         with tf.Graph().as_default() as graph:
 
@@ -186,7 +195,10 @@ class SpeechRec:
             with tf.Session(graph=graph) as session:
                 session.run('prefix/initialize_state')
 
-                features = audio_to_input_vector(audio, fs, n_input, n_context)
+                if features is None:
+                    features = audio_to_input_vector(audio, fs, n_input, n_context)
+                else:
+                    features = features_to_input_vector(features, n_input, n_context)
                 num_strides = len(features) - (n_context * 2)
                 window_size = 2 * n_context + 1
 
@@ -204,6 +216,8 @@ class SpeechRec:
                 logits = np.empty([0, 1, self.alphabet.size() + 1])
 
                 for i in range(0, len(features), n_steps):
+                    if cancel is not None and cancel.is_set():
+                        break
                     chunk = features[i:i + n_steps]
 
                     # pad with zeros if not enough steps (len(features) % FLAGS.n_steps != 0)
@@ -0,0 +1,73 @@
+""" Framed audio as sent by the web server in audio:{id}.
+
+A frame is a 16 byte little-endian header followed by int16 PCM samples:
+
+    magic       4s  b'YAUD'
+    version     H   FORMAT_VERSION
+    channels    H   always 1
+    sample_rate I
+    n_samples   I   0 means "up to the end of the buffer" (for streamed uploads)
+
+Streamed requests send the header first and the samples in pieces as they are recorded.
+
+The web server downmixes and resamples uploads to CANONICAL_SAMPLE_RATE once, so the
+processor never decodes a container format. app/login/audio.py is the encoder.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'YAUD'
+FORMAT_VERSION = 1
+CANONICAL_SAMPLE_RATE = 16000
+
+HEADER = struct.Struct('<4sHHII')
+_DTYPE = np.dtype('<i2')
+
+
+def is_framed(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode(samples, sample_rate):
+    """ :param samples: 1-d int16 array
+    :return: framed audio bytes """
+    samples = np.ascontiguousarray(samples, dtype=_DTYPE)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, 1, sample_rate, len(samples)) + samples.tobytes()
+
+
+def read_header(data):
+    """ :return: (sample_rate, n_samples) from the header at the start of data """
+    magic, version, channels, sample_rate, n_samples = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not framed audio")
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported audio format version {}".format(version))
+    if channels != 1:
+        raise ValueError("Framed audio must be mono, got {} channels".format(channels))
+    return sample_rate, n_samples
+
+
+def decode(data):
+    """ View framed audio without copying
+
+    :param data: bytes-like object produced by encode
+    :return: (int16 samples, sample_rate)
+    """
+    sample_rate, n_samples = read_header(data)
+    available = (len(data) - HEADER.size) // _DTYPE.itemsize
+    count = n_samples if n_samples else available
+    if count > available:
+        raise ValueError("Framed audio truncated: {} of {} samples".format(available, count))
+    return np.frombuffer(data, dtype=_DTYPE, count=count, offset=HEADER.size), sample_rate
+
+
+def samples_from(data):
+    """ View the whole int16 samples at the start of headerless data
+    :return: (samples, number of trailing bytes of an incomplete sample) """
+    count = len(data) // _DTYPE.itemsize
+    return np.frombuffer(data, dtype=_DTYPE, count=count), len(data) - count * _DTYPE.itemsize
+
+
+def to_float(samples):
+    """ int16 samples scaled to [-1, 1) as float64, as soundfile reads them """
+    return samples / 32768.0
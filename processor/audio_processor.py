@@ -2,12 +2,13 @@ import soundfile as sf
 import io
 import logging
 import gin
-import librosa
-from pydub import AudioSegment
 import numpy as np
 from io import BytesIO
-import speechpy
 from scipy.io import wavfile
+from processor import metrics
+from processor import audio_format
+from processor.frontend import LogMelFrontend, IncrementalLogMel, DeepSpeechMFCC, voiced_range
+from data.processing.resample import resample
 
 @gin.configurable
 class AudioProcessor:
@@ -15,51 +16,180 @@ class AudioProcessor:
     def __init__(self,
                  window_size=2048,
                  num_feats=64,
-                 sample_rate=None):
+                 sample_rate=None,
+                 vad=False,
+                 vad_margin_db=40,
+                 vad_padding=10,
+                 vad_min_frames=150,
+                 shared_frontend=False):
+        """
+        :param sample_rate: rate every recording is resampled to before featurization,
+            or None to featurize at the rate it arrives in
+        :param vad: trim leading and trailing silence before the models see the audio
+        :param vad_margin_db: frames whose loudest filter is this far below the loudest
+            frame's are silent
+        :param vad_padding: frames of silence kept on either side of the speech
+        :param vad_min_frames: keep the whole recording if less than this remains
+        :param shared_frontend: also derive the presence detection MFCCs from the power
+            spectrum computed for the log mel features, instead of presence detection
+            computing its own (see DeepSpeechMFCC for how they differ)
+        """
         self.window_size = window_size
         self.num_feats = num_feats
-        self.default_sample_rate = sample_rate
+        self.sample_rate = sample_rate
+        self.vad = vad
+        self.vad_margin_db = vad_margin_db
+        self.vad_padding = vad_padding
+        self.vad_min_frames = vad_min_frames
+        self.frontend = LogMelFrontend(num_filters=num_feats)
+        self.mfcc = DeepSpeechMFCC(fft_length=self.frontend.fft_length) if shared_frontend else None
         self.logger = logging.getLogger('audioProcessor')
 
+    def _normalize(self, mel):
+        return mel - np.mean(mel, axis=0, dtype=np.float64)
+
+    def _resample(self, data, fs):
+        """ :return: (data, fs) at sample_rate """
+        if self.sample_rate is None or fs == self.sample_rate:
+            return data, fs
+        with metrics.timed("resample"):
+            return resample(data, fs, self.sample_rate), self.sample_rate
+
+    def _featurize(self, data, fs):
+        data, fs = self._resample(data, fs)
+        with metrics.timed("featurize"):
+            return self._normalize(self.frontend(data, fs))
+
+    def _trim(self, mel, data, fs, mfcc=None):
+        """ Drop the silent frames at either end of mel (and mfcc) and their samples
+        from data, using the filterbank energies already computed for the models """
+        first, last = voiced_range(mel, self.vad_margin_db, self.vad_padding)
+        if last - first < self.vad_min_frames:
+            return mel, data, mfcc
+        frame_size, stride = self.frontend.frame_sizes(fs)
+        self.logger.info("VAD kept frames %s to %s of %s", first, last, len(mel))
+        if mfcc is not None:
+            mfcc = mfcc[first:last]
+        return mel[first:last], data[first * stride:(last - 1) * stride + frame_size], mfcc
+
+    def _split(self, mel, data, fs, split, mfcc=None):
+        """ :return: (normalized features of each of split parts of mel, data, mfcc) """
+        if self.vad:
+            mel, data, mfcc = self._trim(mel, data, fs, mfcc)
+        bounds = np.linspace(0, len(mel), split + 1).astype(int)
+        return [self._normalize(mel[bounds[i]:bounds[i + 1]]) for i in range(split)], data, mfcc
+
+    def _featurize_whole(self, data, fs, split):
+        """ Featurize data with one STFT, which with shared_frontend also gives the
+        presence detection MFCCs of a single utterance
+
+        :return: as _split
+        """
+        power = self.frontend.power(data, fs)
+        mfcc = self.mfcc(power, fs) if self.mfcc is not None and split == 1 else None
+        return self._split(self.frontend.log_mel(power, fs), data, fs, split, mfcc)
+
+    def _forward_framed(self, audio_bytes, split):
+        with metrics.timed("decode"):
+            samples, fs = audio_format.decode(audio_bytes)
+            data = audio_format.to_float(samples)
+
+        data, fs = self._resample(data, fs)
+        with metrics.timed("featurize"):
+            all_mels, data, mfcc = self._featurize_whole(data, fs, split)
+        return all_mels, fs, data, mfcc
+
+    def forward_stream(self, chunks):
+        """ Featurize framed audio while it arrives, so only the frames of the last chunk
+        are left to compute once the stream ends. Audio that is not at sample_rate is
+        resampled and featurized once it has all arrived instead.
+
+        :param chunks: iterable of bytes, which joined are framed audio
+        :return: as forward
+        """
+        pending = b''
+        featurizer = None
+        fs = None
+        parts = []
+        for chunk in chunks:
+            pending += chunk
+            if fs is None:
+                if len(pending) < audio_format.HEADER.size:
+                    continue
+                fs, _ = audio_format.read_header(pending)
+                pending = pending[audio_format.HEADER.size:]
+                if self.sample_rate in (None, fs):
+                    featurizer = IncrementalLogMel(self.frontend, fs, self.mfcc)
+                else:
+                    self.logger.warning("Streamed audio at %s Hz is featurized after it ends", fs)
+
+            samples, remainder = audio_format.samples_from(pending)
+            data = audio_format.to_float(samples)
+            pending = pending[len(pending) - remainder:]
+            parts.append(data)
+            if featurizer is not None:
+                featurizer.feed(data)
+
+        if not parts:
+            raise ValueError("Audio stream ended before its samples")
+        data = np.concatenate(parts)
+        if featurizer is None:
+            data, fs = self._resample(data, fs)
+            with metrics.timed("featurize"):
+                all_mels, data, mfcc = self._featurize_whole(data, fs, 1)
+            return all_mels, fs, data, mfcc
+
+        with metrics.timed("featurize"):
+            mel, mfcc = featurizer.finish()
+            all_mels, data, mfcc = self._split(mel, data, fs, 1, mfcc)
+        return all_mels, fs, data, mfcc
+
     def forward(self, audio_bytes, split=1):
-        # TODO: Add split logic
+        """ :return: (normalized log mel features of each of split parts of the audio,
+        sample rate, samples, presence detection MFCCs or None) """
+        # Uploads normalized by the web server, anything else is decoded as a wav file
+        if audio_format.is_framed(audio_bytes):
+            return self._forward_framed(audio_bytes, split)
 
         audio_stream = io.BytesIO(audio_bytes)
 
         all_mels = []
+        mfcc = None
 
         if split > 1:
+            from pydub import AudioSegment
             newAudio = AudioSegment.from_wav(audio_stream)
             duration_ms = newAudio.duration_seconds * 1000
             splits = np.cumsum([0] + [int(duration_ms) // split for _ in range(split)])
             segments = [newAudio[splits[i]:splits[i + 1]] for i in range(len(splits) - 1)]
 
             for segment in segments:
-                segment.export("temp.wav", format='wav')
-                with open("temp.wav", 'rb') as f:
-                    data, source_sample_rate = sf.read(f, always_2d=True)
-                    data = data[:, 0]
-                self.logger.info("Source sample rate is {}".format(source_sample_rate))
-                mel = speechpy.feature.lmfe(data, sampling_frequency=source_sample_rate, num_filters=64)
-                mel = mel - np.mean(mel, axis=0, dtype=np.float64)
-                all_mels.append(mel)
+                with metrics.timed("decode"):
+                    segment.export("temp.wav", format='wav')
+                    with open("temp.wav", 'rb') as f:
+                        data, source_sample_rate = sf.read(f, always_2d=True)
+                        data = data[:, 0]
+                self.logger.info("Source sample rate is %s", source_sample_rate)
+                all_mels.append(self._featurize(data, source_sample_rate))
         else:
-            data, source_sample_rate = sf.read(audio_stream, always_2d=True)
-            data = data[:, 0]
-            self.logger.info("Source sample rate is {}".format(source_sample_rate))
-            mel = speechpy.feature.lmfe(data, sampling_frequency=source_sample_rate, num_filters=64)
-            mel = mel - np.mean(mel, axis=0, dtype=np.float64)
-            all_mels.append(mel)
+            with metrics.timed("decode"):
+                data, source_sample_rate = sf.read(audio_stream, always_2d=True)
+                data = data[:, 0]
+            self.logger.info("Source sample rate is %s", source_sample_rate)
+            data, source_sample_rate = self._resample(data, source_sample_rate)
+            with metrics.timed("featurize"):
+                all_mels, data, mfcc = self._featurize_whole(data, source_sample_rate, 1)
 
-        return all_mels, source_sample_rate, data
+        return all_mels, source_sample_rate, data, mfcc
 
 
     def from_file(self, path):
         source_sample_rate, data = wavfile.read(path)
         if len(data.shape) > 1:
             data = data[:, 0]
-        self.logger.info("Source sample rate is {}".format(source_sample_rate))
-        mel = speechpy.feature.lmfe(data, sampling_frequency=source_sample_rate, num_filters=64)
+        self.logger.info("Source sample rate is %s", source_sample_rate)
+        data, source_sample_rate = self._resample(data, source_sample_rate)
+        mel = self.frontend(data, source_sample_rate)
         mel = mel - np.mean(mel, axis=0, dtype=np.float64)
         return [mel]
 
@@ -0,0 +1,268 @@
+""" Micro-benchmarks for the processor's hot paths on synthetic inputs.
+
+    python -m processor.benchmark --output bench.json
+    python -m processor.benchmark --baseline bench.json --max-slowdown 1.25
+
+Each benchmark reports the mean, median and minimum seconds over --repeats runs. With
+--baseline, any benchmark whose median is more than --max-slowdown times the
+baseline median is reported and the run exits non-zero.
+
+Classification benchmarks use an in-memory sqlite database and the scratch redis
+database --redis-db, so they never touch demo1.db or the processor's redis keys.
+"""
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import time
+from io import BytesIO
+import numpy as np
+import redis
+import torch
+from peewee import SqliteDatabase
+import processor.db as db_core
+from processor.audio_processor import AudioProcessor
+from processor.speaker_classification_processor import SpeakerClassificationProcessor
+from processor.speaker_embedding_processor import SpeakerEmbeddingInference, process_data_batch
+from processor.speaker_model_format import serialize_speaker_model
+from processor.web_server_emulator import synthesize, synthesize_wav
+from processor import audio_format
+from data.processing.resample import resample
+from training.speaker_verification.model import IdentifyAndEmbed
+from presence_detection.fb import PresenceScore
+
+EMBEDDING_SIZE = 256
+NUM_FEATS = 64
+TABLES = [db_core.User, db_core.Embedding, db_core.Audio, db_core.SpeakerModelBlob]
+
+
+def measure(fn, repeats=5, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    times = np.asarray(times)
+    return {"mean": float(times.mean()), "median": float(np.median(times)), "min": float(times.min()),
+            "repeats": repeats}
+
+
+def random_utterances(n, rng, min_frames=200, max_frames=1000):
+    return [rng.randn(rng.randint(min_frames, max_frames), NUM_FEATS).astype(np.float32) for _ in range(n)]
+
+
+def bench_audio(results, repeats, durations=(2, 5, 10), sample_rates=(16000, 22050, 44100)):
+    from python_speech_features import mfcc
+    audio_processor = AudioProcessor()
+    shared_audio_processor = AudioProcessor(shared_frontend=True)
+    rng = np.random.RandomState(0)
+    for sample_rate in sample_rates:
+        for seconds in durations:
+            wav = synthesize_wav(seconds, sample_rate=sample_rate, rng=rng)
+            results["audio_processor/{}hz/{}s".format(sample_rate, seconds)] = \
+                measure(lambda: audio_processor(wav), repeats)
+
+    # Resampling to the models' rate, with the filter for each pair of rates designed once
+    for sample_rate in sample_rates:
+        if sample_rate != audio_format.CANONICAL_SAMPLE_RATE:
+            data = synthesize(5, sample_rate, rng) / 32768.0
+            results["resample/{}hz/5s".format(sample_rate)] = \
+                measure(lambda: resample(data, sample_rate, audio_format.CANONICAL_SAMPLE_RATE), repeats)
+
+    # Uploads as normalized by the web server
+    for seconds in durations:
+        framed = audio_format.encode(synthesize(seconds, audio_format.CANONICAL_SAMPLE_RATE, rng),
+                                     audio_format.CANONICAL_SAMPLE_RATE)
+        results["audio_processor/framed/{}s".format(seconds)] = measure(lambda: audio_processor(framed), repeats)
+        # The presence detection MFCCs from the same STFT, against computing them separately
+        results["audio_processor/framed_shared_mfcc/{}s".format(seconds)] = \
+            measure(lambda: shared_audio_processor(framed), repeats)
+        data = audio_format.to_float(audio_format.decode(framed)[0])
+        results["mfcc/python_speech_features/{}s".format(seconds)] = \
+            measure(lambda: mfcc(data, samplerate=audio_format.CANONICAL_SAMPLE_RATE, numcep=26), repeats)
+
+        # Streamed logins, in 250 ms pieces
+        pieces = [framed[i:i + 8000] for i in range(0, len(framed), 8000)]
+        results["audio_processor/stream/{}s".format(seconds)] = \
+            measure(lambda: audio_processor.forward_stream(pieces), repeats)
+
+
+def bench_batching(results, repeats, batch_sizes=(1, 8, 32)):
+    rng = np.random.RandomState(0)
+    for batch_size in batch_sizes:
+        utterances = random_utterances(batch_size, rng)
+        for mode in ("zeros", "wrap"):
+            results["process_data_batch/{}/n{}".format(mode, batch_size)] = \
+                measure(lambda: process_data_batch(utterances, mode=mode), repeats)
+
+
+def bench_embedding(results, repeats, batch_sizes=(1, 4, 16), frames=500):
+    # Randomly initialised weights cost the same to run as the trained checkpoint
+    inference = SpeakerEmbeddingInference(IdentifyAndEmbed(nspeakers=1200))
+    rng = np.random.RandomState(0)
+    for batch_size in batch_sizes:
+        utterances = [u for u in rng.randn(batch_size, frames, NUM_FEATS).astype(np.float32)]
+        results["embedding/n{}/{}frames".format(batch_size, frames)] = \
+            measure(lambda: inference.forward(utterances), repeats)
+
+
+class ScratchClassification:
+    """ A SpeakerClassificationProcessor over an in-memory database and a scratch redis db """
+
+    def __init__(self, mode, redis_db, rng):
+        self.rng = rng
+        self.conn = redis.Redis(db=redis_db)
+        self.db = SqliteDatabase(':memory:')
+        self.db.bind(TABLES)
+        self.db.connect()
+        self.db.create_tables(TABLES)
+
+        self.classifier = SpeakerClassificationProcessor(mode=mode)
+        self.classifier.redis_conn = self.conn
+        self.classifier.registry.redis_conn = self.conn
+
+        external = rng.randn(200, EMBEDDING_SIZE)
+        with BytesIO() as b:
+            np.save(b, external)
+            self.conn.set('external', b.getvalue())
+
+    def add_users(self, k, embeddings_per_user=6):
+        """ :return: list of user ids, each with embeddings clustered around its own centroid """
+        user_ids = []
+        with self.db.atomic():
+            for i in range(k):
+                user = db_core.User.create(username="bench-{}".format(i))
+                centroid = self.rng.randn(EMBEDDING_SIZE)
+                for j in range(embeddings_per_user):
+                    embedding = centroid + 0.3 * self.rng.randn(EMBEDDING_SIZE)
+                    db_core.create_embedding_record(user, embedding, rec_id="{}:{}".format(i, j))
+                user_ids.append(user.id)
+        return user_ids
+
+    def add_speaker_models(self, user_ids, n_trained=5):
+        """ Give every user a real fitted model without fitting one per user: n_trained
+        models are fitted on synthetic speakers and their blobs are shared round-robin """
+        blobs = {'lr': [], 'svm': []}
+        negatives = self.rng.randn(500, EMBEDDING_SIZE)
+        for _ in range(n_trained):
+            positives = self.rng.randn(EMBEDDING_SIZE) + 0.3 * self.rng.randn(6, EMBEDDING_SIZE)
+            blobs['lr'].append(serialize_speaker_model(
+                self.classifier.getLogisticRegressionParams(positives, negatives), 0.5))
+            blobs['svm'].append(serialize_speaker_model(self.classifier.getSVMParams(positives, negatives), 0.5))
+
+        rows = [{"user": user_id, "mode": mode, "data": mode_blobs[i % n_trained]}
+                for mode, mode_blobs in blobs.items() for i, user_id in enumerate(user_ids)]
+        with self.db.atomic():
+            for i in range(0, len(rows), 200):
+                db_core.SpeakerModelBlob.insert_many(rows[i:i + 200]).execute()
+        self.classifier.registry.invalidate()
+
+    def close(self):
+        self.db.drop_tables(TABLES)
+        self.db.close()
+        self.conn.delete('external', self.classifier.registry.version_key)
+
+
+def bench_classification(results, repeats, redis_db, num_users=(10, 100, 1000), modes=('lr', 'svm')):
+    rng = np.random.RandomState(0)
+    for mode in modes:
+        for k in num_users:
+            scratch = ScratchClassification(mode, redis_db, rng)
+            scratch.add_speaker_models(scratch.add_users(k))
+            query = rng.randn(EMBEDDING_SIZE)
+
+            # The first query after an update decodes every model from the database
+            results["classify_speaker/{}/k{}/cold".format(mode, k)] = measure(
+                lambda: (scratch.classifier.registry.invalidate(), scratch.classifier.classify_speaker(query)),
+                repeats, warmup=0)
+            results["classify_speaker/{}/k{}".format(mode, k)] = \
+                measure(lambda: scratch.classifier.classify_speaker(query), repeats)
+            scratch.close()
+
+
+def bench_update_speakers(results, redis_db, num_users=(10, 100)):
+    # Trains two models per user, so a single run per size
+    rng = np.random.RandomState(0)
+    for k in num_users:
+        scratch = ScratchClassification('svm', redis_db, rng)
+        scratch.add_users(k)
+        results["update_speakers/k{}".format(k)] = measure(scratch.classifier.update_speakers, repeats=1, warmup=0)
+        scratch.close()
+
+
+def bench_presence(results, repeats, num_frames=(100, 250, 500), prompt="my voice is my password"):
+    presence_score = PresenceScore()
+    chars = list(" abcdefghijklmnopqrstuvwxyz'") + ["-"]
+    torch.manual_seed(0)
+    for frames in num_frames:
+        log_probs = torch.log_softmax(torch.randn(frames, len(chars)), dim=1)
+        results["presence_score/{}frames".format(frames)] = \
+            measure(lambda: presence_score.forward(prompt, log_probs, chars), repeats)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "torch": torch.__version__, "torch_threads": torch.get_num_threads(), "machine": platform.machine()}
+
+
+def regressions(results, baseline, max_slowdown):
+    """ :return: list of (name, baseline median, median) for benchmarks slower than max_slowdown x baseline """
+    slower = []
+    for name, result in results.items():
+        if name in baseline and result["median"] > max_slowdown * baseline[name]["median"]:
+            slower.append((name, baseline[name]["median"], result["median"]))
+    return slower
+
+
+BENCHMARKS = ("audio", "batching", "embedding", "classification", "update_speakers", "presence")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", type=str, nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--redis-db", type=int, default=15, help="scratch redis database for classification")
+    parser.add_argument("--output", type=str, default=None, help="write results as json")
+    parser.add_argument("--baseline", type=str, default=None, help="results json to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=1.25)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {}
+    if "audio" in args.only:
+        bench_audio(results, args.repeats)
+    if "batching" in args.only:
+        bench_batching(results, args.repeats)
+    if "embedding" in args.only:
+        bench_embedding(results, args.repeats)
+    if "classification" in args.only:
+        bench_classification(results, args.repeats, args.redis_db)
+    if "update_speakers" in args.only:
+        bench_update_speakers(results, args.redis_db)
+    if "presence" in args.only:
+        bench_presence(results, args.repeats)
+
+    for name, result in results.items():
+        print("{:<45} median {:10.6f}s  min {:10.6f}s".format(name, result["median"], result["min"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        slower = regressions(results, baseline, args.max_slowdown)
+        for name, baseline_median, median in slower:
+            print("REGRESSION {}: {:.6f}s -> {:.6f}s ({:.2f}x)".format(name, baseline_median, median,
+                                                                     median / baseline_median))
+        if slower:
+            raise SystemExit(1)
@@ -0,0 +1,19 @@
+""" One redis connection pool per processor process.
+
+Every component takes its client from get_redis_conn, so they share connections
+instead of each opening its own. redis-py pools detect a fork and reconnect, so
+forked workers get fresh sockets on first use.
+"""
+import gin
+import redis
+
+_pool = None
+
+
+@gin.configurable
+def get_redis_conn(host="127.0.0.1", port=6379, db=0, max_connections=None):
+    """ :return: redis client backed by the process-wide connection pool """
+    global _pool
+    if _pool is None:
+        _pool = redis.ConnectionPool(host=host, port=port, db=db, max_connections=max_connections)
+    return redis.Redis(connection_pool=_pool)
@@ -1,62 +1,105 @@
+import time
+_import_start = time.perf_counter()
+
 import gin
-import redis
 import json
 import torch
-import time
 from processor.speaker_classification_processor import SpeakerClassificationProcessor
-from processor.speaker_embedding_processor import SpeakerEmbeddingProcessor
-from processor.speaker_embedding_processor import SpeakerEmbeddingInference
+from processor.embedding_server import get_embedding_processor
 from processor.presence_detection_processor import PresenceDetectionProcessor
 from processor.external import load_voxceleb_embeddings
 from processor.audio_processor import AudioProcessor
+from processor.startup import StageTimer
+from processor import metrics
+from processor import log
+from processor.connections import get_redis_conn
+from processor.queues import RequestQueue, StreamAborted, expired
 import processor.db as db_core
 import processor.utils as U
-import sklearn.linear_model
 import os
+import gc
+import socket
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-from multiprocessing import Process
+import multiprocessing
 import logging
 from peewee import SqliteDatabase
 import numpy as np
 from io import BytesIO
 
+_import_time = time.perf_counter() - _import_start
+
+
 @gin.configurable
 class YoloProcessor:
 
     def __init__(self,
                  registration_split=3,
                  load_external=False,
-                 load_fixtures=False):
+                 load_fixtures=False,
+                 num_workers=1,
+                 worker_threads=None,
+                 enable_presence=False,
+                 concurrent_presence=True,
+                 short_circuit=True,
+                 stream_workers=1):
+        """
+        :param concurrent_presence: run presence detection on its own thread alongside
+            speaker embedding and classification
+        :param short_circuit: stop the other check of an authentication once speaker
+            identification or presence detection rejects it
+        :param stream_workers: threads per worker serving streamed logins, which hold
+            their thread for as long as the user speaks
+        """
         self.registration_split = registration_split
         self.load_external = load_external
-        self.speaker_classification = SpeakerClassificationProcessor()
-        self.embedding_processor = SpeakerEmbeddingProcessor()
-        self.presence_detection_processor = PresenceDetectionProcessor()
-        self.audio_processing = AudioProcessor()
-        self.redis_conn = redis.Redis()
-        for handler in logging.root.handlers[:]:
-            logging.root.removeHandler(handler)
+        self.num_workers = num_workers
+        self.worker_threads = worker_threads
+        self.concurrent_presence = concurrent_presence
+        self.short_circuit = short_circuit
+        self.stream_workers = stream_workers
+        self.worker_idx = 0
+        self._presence_executor = None
+
         # Set up processor logging
-        logging.basicConfig(
-                            filename='yolo_processor.log',
-                            filemode='a',
-                            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-                            datefmt='%H:%M:%S',
-                            level=logging.INFO)
+        log.setup_logging()
 
         logging.info("Yolo Processor")
         self.logger = logging.getLogger('yoloProcessor')
 
+        timer = StageTimer()
+        timer.add("imports", _import_time)
+
+        with timer.stage("classification"):
+            self.speaker_classification = SpeakerClassificationProcessor()
+        with timer.stage("embedding"):
+            self.embedding_processor = get_embedding_processor()
+        with timer.stage("presence"):
+            # Loads TensorFlow and the DeepSpeech graph, so only when presence checks are on
+            self.presence_detection_processor = PresenceDetectionProcessor() if enable_presence else None
+        with timer.stage("audio"):
+            self.audio_processing = AudioProcessor()
+        self.redis_conn = get_redis_conn()
+        self.request_queue = RequestQueue(self.redis_conn, is_registered=db_core.user_exists)
+
         # database
-        self.db = self._init_db()
+        with timer.stage("database"):
+            self.db = self._init_db()
 
         # setup
-        self._setup()
+        with timer.stage("external"):
+            self._setup()
 
         # demo fixtures
         if load_fixtures:
-            db_core.clear_all_db_records()
-            self._add_fixtures("internal_data/")
+            with timer.stage("fixtures"):
+                db_core.clear_all_db_records()
+                self._add_fixtures("internal_data/")
+                self.request_queue.sync_usernames(db_core.load_usernames().values())
+
+        self.logger.info(timer.report())
 
 
     def _add_fixtures(self, fixtures_path):
@@ -90,20 +133,90 @@ class YoloProcessor:
 
 
 
-    def run(self):
+    def run_workers(self):
+        """ Serve requests from num_workers processes forked from this one.
+
+        Models are loaded once in the parent and the weights are moved to shared memory
+        before forking, so workers inherit them without copying.
+        """
+        if self.num_workers <= 1:
+            return self.run()
+
+        self.embedding_processor.share_memory()
+
+        # sqlite connections must not cross a fork, each worker opens its own
+        self.db.close()
 
+        # Keep the collector from touching (and so copying) the parent's objects
+        gc.freeze()
+
+        ctx = multiprocessing.get_context('fork')
+        workers = [ctx.Process(target=self._run_worker, args=(i,)) for i in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def _run_worker(self, worker_idx):
+        self.worker_idx = worker_idx
+        # The log writer thread does not survive the fork
+        log.setup_logging()
+        self.db.connect(reuse_if_open=True)
+        if self.worker_threads:
+            torch.set_num_threads(self.worker_threads)
+        self.logger.info("Worker %s started with pid %s", worker_idx, os.getpid())
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.db.close()
+
+    def run(self):
+        # Started here rather than in __init__ since threads do not survive the fork into workers
+        metrics.REGISTRY.add_collector(self._sample_queue_depth)
+        metrics.MetricsExporter(worker=self.worker_idx, redis_conn=self.redis_conn).start()
+        self.request_queue.start("{}:{}".format(socket.gethostname(), os.getpid()))
+        if self.presence_detection_processor is not None and self.concurrent_presence:
+            self._presence_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="presence")
+        for i in range(self.stream_workers):
+            threading.Thread(target=self._serve, args=(self.request_queue.pop_stream,),
+                             name="stream-{}".format(i), daemon=True).start()
+
+        self._serve(self.request_queue.pop)
+
+    def _serve(self, pop):
         while True:
-            request = self.redis_conn.blpop(["queue:requests"], 30)
+            request = pop()
+            if request is None:
+                continue
 
-            # TODO: we should be doing something smarter here
-            if not request:
+            if expired(request):
+                self.request_queue.reject_expired(request)
+                metrics.EXPIRED.inc(request_type=request["type"])
+                self.logger.warning("Dropped expired %s request %s", request["type"], request["id"])
                 continue
 
-            result = self._process(json.loads(request[1].decode('utf-8')))
+            try:
+                self._process(request)
+            except StreamAborted:
+                self.logger.info("Client abandoned %s request %s", request["type"], request["id"])
+            except Exception:
+                # Answer the client rather than leaving it to wait out its deadline
+                self.logger.exception("Failed to process %s request %s", request["type"], request["id"])
+                self.request_queue.fail(request)
+            self.request_queue.ack(request)
+
+    def _sample_queue_depth(self):
+        for request_type, depth in self.request_queue.depths().items():
+            metrics.QUEUE_DEPTH.set(depth, queue=request_type)
 
     def _setup(self):
         # Load external dataset embeddings
 
+        # The web server checks new usernames against this set
+        self.request_queue.sync_usernames(db_core.load_usernames().values())
+
         if not self.redis_conn.exists('external') or self.load_external:
             external_embeddings = []
             external_embeddings.append(load_voxceleb_embeddings())
@@ -117,7 +230,7 @@ class YoloProcessor:
     def _init_db(self):
         db = db_core.get_db_conn()
         db.connect()
-        db.create_tables([db_core.User, db_core.Embedding, db_core.Audio, db_core.SpeakerModel, db_core.SpeakerModelSVM])
+        db.create_tables([db_core.User, db_core.Embedding, db_core.Audio, db_core.SpeakerModelBlob])
         return db
 
     def _process(self, request):
@@ -125,28 +238,54 @@ class YoloProcessor:
         # Parse request data
         request_id = request["id"]
         request_type = request["type"]
-        self.logger.log(logging.INFO, "{} request {} received".format(request_type, request_id))
-
-        if request_type == "register":
-            username = request['name']
-            self._register(request_id, username)
-        elif request_type == "authenticate":
-            self._authenticate(request_id, request["prompt"])
+        with metrics.request_context(request_type), log.request_context(request_id):
+            self.logger.info("%s request received", request_type)
+            if request_type == "register":
+                username = request['name']
+                self._register(request_id, username)
+            elif request_type == "authenticate":
+                self._authenticate(request_id, request["prompt"], request.get("stream", False))
 
         return request
 
-    def _authenticate(self, id_, prompt):
-        audio_bytes = self.redis_conn.get('audio:{}'.format(id_))
-        # U.play_audio(audio_bytes)
-        processed_utterance, fs, audio_data = self.audio_processing(audio_bytes)
-        embeddings = self.embedding_processor(processed_utterance)
-        id_decision = self.speaker_classification.classify_speaker(embeddings.squeeze(0).numpy())
-        presence_decision = True # self.presence_detection_processor(prompt, audio_data, fs)
+    def _authenticate(self, id_, prompt, stream=False):
+        if stream:
+            # Featurized while the user speaks, only the last frames are left when they stop
+            processed_utterance, fs, audio_data, mfcc = \
+                self.audio_processing.forward_stream(self.request_queue.stream(id_))
+        else:
+            with metrics.timed("redis"):
+                audio_bytes = self.redis_conn.get('audio:{}'.format(id_))
+            # U.play_audio(audio_bytes)
+            processed_utterance, fs, audio_data, mfcc = self.audio_processing(audio_bytes)
+
+        # Set by whichever check rejects first, so that the other can stop early
+        cancel = threading.Event()
+        presence = None
+        if self._presence_executor is not None:
+            # The log and metric labels of this request are thread local
+            presence = self._presence_executor.submit(
+                contextvars.copy_context().run, self._detect_presence, metrics.current_request_type(),
+                prompt, audio_data, fs, mfcc, cancel)
+
+        id_decision = self._identify(processed_utterance, cancel)
+        if id_decision is None and self.short_circuit:
+            cancel.set()
+
+        if self.presence_detection_processor is None:
+            presence_decision = True
+        elif presence is not None:
+            presence_decision = presence.result()
+        elif cancel.is_set():
+            presence_decision = False
+        else:
+            presence_decision = self._detect_presence(metrics.current_request_type(), prompt, audio_data, fs,
+                                                      mfcc, cancel)
 
         if id_decision is None:
             username = None
         elif presence_decision:
-            username = db_core.User.get(db_core.User.id == id_decision).username
+            username = self.speaker_classification.registry.usernames.get(id_decision)
         else:
             username = None
 
@@ -155,41 +294,85 @@ class YoloProcessor:
         }
 
         # Send the result to the client
-        self.redis_conn.set("result:{}".format(id_), json.dumps(result))
-        self.logger.log(logging.INFO, "ID Decision is: {}".format(username))
-        self.logger.log(logging.INFO, "Presence Decision is: {}".format(presence_decision))
-        self.logger.log(logging.INFO, "Authenticated request {}".format(id_))
+        with metrics.timed("redis"):
+            self.request_queue.write_result(id_, result)
+        self.logger.info("ID Decision is: %s", username)
+        self.logger.info("Presence Decision is: %s", presence_decision)
+        self.logger.info("Authenticated request")
         return username
 
 
-    def _register(self, request_id, username):
-        # Add user to the database
-        user = db_core.User(username=username)
-        user.save()
+    def _identify(self, processed_utterance, cancel):
+        """ :return: id of the speaker of processed_utterance, or None if it is not a
+        registered user or presence detection rejected it first """
+        with metrics.timed("embed"):
+            embeddings = self.embedding_processor(processed_utterance)
+        if cancel.is_set():
+            return None
+        with metrics.timed("classify"):
+            return self.speaker_classification.classify_speaker(embeddings.squeeze(0).numpy())
+
+    def _detect_presence(self, request_type, prompt, audio_data, fs, mfcc, cancel):
+        with metrics.stage_labels(request_type), metrics.timed("presence"):
+            decision = self.presence_detection_processor(prompt, audio_data, fs, mfcc, cancel=cancel)
+        if not decision and self.short_circuit:
+            cancel.set()
+        return decision
 
-        audio_bytes = self.redis_conn.get('audio:{}'.format(request_id))
-        processed_utterances, _, _ = self.audio_processing(audio_bytes, split=6)
-        embeddings = self.embedding_processor(processed_utterances)
+    def _register(self, request_id, username):
+        with metrics.timed("db"):
+            exists = db_core.user_exists(username)
+            retried = exists and db_core.registered_by(username, request_id)
+        if retried:
+            # Requeued after this request committed the user, finish what it started
+            self.logger.info("User %s was already registered by this request", username)
+            self._finish_registration(request_id, username)
+            return
+        if exists:
+            # The web server's claim on the name should have prevented this
+            self.logger.warning("User %s is already registered", username)
+            self.request_queue.write_result(request_id, {"username": None, "error": "duplicate"})
+            return
+
+        with metrics.timed("redis"):
+            audio_bytes = self.redis_conn.get('audio:{}'.format(request_id))
+        processed_utterances, _, _, _ = self.audio_processing(audio_bytes, split=6)
+        with metrics.timed("embed"):
+            embeddings = self.embedding_processor(processed_utterances)
         embeddings = embeddings.numpy()
 
-        for i in range(embeddings.shape[0]):
-            embedding_data = embeddings[i]
-            db_core.create_embedding_record(user=user, embedding=embedding_data, rec_id="{}:{}".format(request_id, i))
+        # Add the user only together with its embeddings, so a failed registration leaves no user
+        with metrics.timed("db"), self.db.atomic():
+            user = db_core.User(username=username)
+            user.save()
+            for i in range(embeddings.shape[0]):
+                embedding_data = embeddings[i]
+                db_core.create_embedding_record(user=user, embedding=embedding_data,
+                                                rec_id="{}:{}".format(request_id, i))
 
-        self.speaker_classification.update_speakers()
+        self._finish_registration(request_id, username)
 
-        self.logger.log(logging.INFO, "Registration complete for request {}".format(request_id))
+    def _finish_registration(self, request_id, username):
+        with metrics.timed("train"):
+            self.speaker_classification.update_speakers()
+
+        # Lets callers such as the load generator observe completion
+        with metrics.timed("redis"):
+            self.request_queue.write_result(request_id, {"username": username})
+
+        self.logger.info("Registration complete")
 
 
 if __name__ == "__main__":
-    gin.external_configurable(redis.Redis, module="redis")
+    import sklearn.linear_model
+
     gin.external_configurable(sklearn.linear_model.LogisticRegression, module="sklearn.linear_model")
 
     gin.parse_config_file("processor/config/prod.gin")
     processor = YoloProcessor()
 
     try:
-        processor.run()
+        processor.run_workers()
     except KeyboardInterrupt as e:
         processor.db.close()
 
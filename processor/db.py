@@ -1,7 +1,7 @@
 from peewee import *
 import datetime
 import numpy as np
-import pickle as pkl
+from processor.speaker_model_format import serialize_speaker_model, deserialize_speaker_model
 _db = None
 
 
@@ -27,17 +27,16 @@ class Embedding(BaseModel):
     data = BlobField()
     user = ForeignKeyField(User, backref='embeddings')
 
-class SpeakerModel(BaseModel):
-    user = ForeignKeyField(User, unique=True)
-    coef = BlobField()
-    intercept = BlobField()
-    n_iter = BlobField()
-    threshold = FloatField()
+class SpeakerModelBlob(BaseModel):
+    """ Per-speaker classifier in the format of processor.speaker_model_format """
+    user = ForeignKeyField(User)
+    mode = CharField()
+    data = BlobField()
 
-class SpeakerModelSVM(BaseModel):
-    user = ForeignKeyField(User, unique=True)
-    serial_model = BlobField()
-    threshold = FloatField()
+    class Meta:
+        indexes = (
+            (('user', 'mode'), True),
+        )
 
 
 
@@ -46,57 +45,40 @@ class Audio(BaseModel):
     embedding = ForeignKeyField(Embedding, unique=True)
 
 
-def write_speaker_model(user, lr_model, threshold):
-    coef_data = lr_model.coef_.astype(np.float64).tostring()
-    intercept_data = lr_model.intercept_.astype(np.float64).tostring()
-    n_iter_data = lr_model.n_iter_.astype(np.float64).tostring()
+def write_speaker_model(user, mode, model, threshold):
+    data = serialize_speaker_model(model, threshold)
+    SpeakerModelBlob.insert(user=user, mode=mode, data=data).on_conflict_replace().execute()
 
-    q = SpeakerModel.select().where(SpeakerModel.user == user)
-    if q.exists():
-        q = SpeakerModel.update({SpeakerModel.coef: coef_data,
-                  SpeakerModel.intercept: intercept_data,
-                  SpeakerModel.n_iter: n_iter_data,
-                  SpeakerModel.threshold: threshold}).where(SpeakerModel.user == user)
-        q.execute()
-    else:
-        sm = SpeakerModel(user=user,
-                          coef=coef_data,
-                          intercept=intercept_data,
-                          n_iter=n_iter_data,
-                          threshold=threshold)
-        sm.save()
-
-
-def load_speaker_model(user, lr_model):
-    sm = SpeakerModel.get(SpeakerModel.user == user)
-    coef_data = np.fromstring(sm.coef).astype(np.float32).reshape(1, -1)
-    intercept_data = np.fromstring(sm.intercept).astype(np.float32)
-    n_iter_data = np.fromstring(sm.n_iter).astype(np.float32)
-    lr_model.coef_ = coef_data
-    lr_model.intercept_ = intercept_data
-    lr_model.n_iter_ = n_iter_data
-    return lr_model, sm.threshold
-
-
-
-def write_speaker_model_svm(user, svm_model, threshold):
-    serial_data = pkl.dumps(svm_model)
-    q = SpeakerModelSVM.select().where(SpeakerModelSVM.user == user)
-    if q.exists():
-        q = SpeakerModelSVM.update({SpeakerModelSVM.serial_model: serial_data,
-                                    SpeakerModelSVM.threshold: threshold}).where(SpeakerModelSVM.user == user)
-        q.execute()
-    else:
-        sm = SpeakerModelSVM(user=user,
-                             serial_model=serial_data,
-                             threshold=threshold)
-        sm.save()
+
+def load_speaker_models(mode):
+    """ Load the speaker models of every user for a classification mode with one query
+
+    :return: list of (user_id, model, threshold)
+    """
+    q = SpeakerModelBlob.select(SpeakerModelBlob.user, SpeakerModelBlob.data).where(SpeakerModelBlob.mode == mode)
+    speaker_models = []
+    for user_id, data in q.tuples():
+        model, threshold = deserialize_speaker_model(data)
+        speaker_models.append((user_id, model, threshold))
+    return speaker_models
+
+
+def load_usernames():
+    """ :return: dict of user id to username for every user """
+    return dict(User.select(User.id, User.username).tuples())
+
+
+def user_exists(username):
+    return User.select().where(User.username == username).exists()
 
 
-def load_speaker_model_svm(user):
-    sm = SpeakerModelSVM.get(SpeakerModelSVM.user == user)
-    svm_model = pkl.loads(sm.serial_model)
-    return svm_model, sm.threshold
+def registered_by(username, request_id):
+    """ :return: whether username was registered by the request request_id, whose
+    embedding records have rec_ids "{request_id}:{i}" """
+    return (Audio.select()
+            .join(Embedding).join(User)
+            .where((User.username == username) & Audio.rec_id.startswith("{}:".format(request_id)))
+            .exists())
 
 
 def create_embedding_record(user, embedding, rec_id):
@@ -112,7 +94,7 @@ def load_embedding_data(embedding, dtype=np.float32):
 
 
 def clear_all_db_records():
-    tables = [SpeakerModel, User, Embedding, Audio]
+    tables = [SpeakerModelBlob, User, Embedding, Audio]
     for table in tables:
         for x in table.select():
             x.delete_instance()
@@ -120,12 +102,12 @@ def clear_all_db_records():
 if __name__ == "__main__":
     db = get_db_conn()
     db.connect()
-    db.create_tables([User, Embedding, Audio, SpeakerModel, SpeakerModelSVM])
+    db.create_tables([User, Embedding, Audio, SpeakerModelBlob])
 
     # Add user
     # User.create(username="Ryan")
 
     user = list(User.select())
-    sms = list(SpeakerModel.select())
+    sms = list(SpeakerModelBlob.select())
     print("hello")
     db.close()
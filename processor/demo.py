@@ -2,7 +2,7 @@ from processor.db import *
 import argparse
 
 def clear_all_db_records():
-    tables = [SpeakerModel, User, Embedding, Audio]
+    tables = [SpeakerModelBlob, User, Embedding, Audio]
     for table in tables:
         for x in table.select():
             x.delete_instance()
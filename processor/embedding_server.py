@@ -0,0 +1,252 @@
+""" Local embedding service shared by processor workers and offline tools.
+
+The server owns the only copy of the embedding model and listens on a unix socket.
+Concurrent requests are coalesced into one inference batch for up to max_wait_ms, or
+until max_batch_size utterances are pending. A model that pools over padding (the
+static int8 export) is served one request at a time instead. Requests are validated as
+they arrive, and a batch that fails anyway is retried one request at a time so that only
+the offending request sees the error.
+
+Wire format (little-endian):
+
+    request:  I count, count x (I frames, I features), float32 utterance data
+    response: B status, I rows, I cols, then float32 (rows, cols) embeddings on
+              success or a utf-8 error message of length rows on failure
+"""
+import argparse
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+import gin
+import numpy as np
+import torch
+from processor.speaker_embedding_processor import SpeakerEmbeddingProcessor
+
+_COUNT = struct.Struct('<I')
+_SHAPE = struct.Struct('<II')
+_RESPONSE = struct.Struct('<BII')
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        k = sock.recv_into(view[received:], n - received)
+        if k == 0:
+            raise EOFError("Connection closed")
+        received += k
+    return buf
+
+
+def _send_utterances(sock, utterances):
+    utterances = [np.ascontiguousarray(u, dtype='<f4') for u in utterances]
+    header = _COUNT.pack(len(utterances)) + b''.join(_SHAPE.pack(*u.shape) for u in utterances)
+    sock.sendall(header + b''.join(u.tobytes() for u in utterances))
+
+
+def _recv_utterances(sock):
+    count, = _COUNT.unpack(_recv_exact(sock, _COUNT.size))
+    shapes = [_SHAPE.unpack_from(_recv_exact(sock, _SHAPE.size)) for _ in range(count)]
+    data = _recv_exact(sock, 4 * sum(t * f for t, f in shapes))
+    utterances = []
+    offset = 0
+    for t, f in shapes:
+        utterances.append(np.frombuffer(data, dtype='<f4', count=t * f, offset=offset).reshape(t, f))
+        offset += 4 * t * f
+    return utterances
+
+
+class _EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                utterances = _recv_utterances(self.request)
+            except EOFError:
+                return
+
+            try:
+                embeddings = self.server.embedding_server.submit(utterances).result()
+                embeddings = np.ascontiguousarray(embeddings, dtype='<f4')
+                response = _RESPONSE.pack(STATUS_OK, *embeddings.shape) + embeddings.tobytes()
+            except Exception as e:
+                message = str(e).encode('utf-8')
+                response = _RESPONSE.pack(STATUS_ERROR, len(message), 0) + message
+            self.request.sendall(response)
+
+
+@gin.configurable
+class EmbeddingServer:
+
+    def __init__(self, socket_path='/tmp/yolo_embedding.sock', max_batch_size=64, max_wait_ms=5, num_feats=64):
+        """
+        :param num_feats: features per frame the model takes
+        """
+        self.socket_path = socket_path
+        self.num_feats = num_feats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.embedding_processor = SpeakerEmbeddingProcessor()
+        self.pending = queue.Queue()
+        self.logger = logging.getLogger('embeddingServer')
+        if not self.embedding_processor.inference_engine.masked:
+            self.logger.warning("Embedding model is unmasked, not coalescing requests")
+            self.max_batch_size = 1
+
+    def submit(self, utterances):
+        """ Queue utterances for the next inference batch
+
+        :return: Future resolving to a (len(utterances), D) numpy array
+        """
+        future = Future()
+        try:
+            self._validate(utterances)
+        except ValueError as e:
+            future.set_exception(e)
+            return future
+        self.pending.put((utterances, future))
+        return future
+
+    def _validate(self, utterances):
+        if not utterances:
+            raise ValueError("No utterances to embed")
+        min_frames = self.embedding_processor.inference_engine.min_frames
+        for t, f in (u.shape for u in utterances):
+            if f != self.num_feats:
+                raise ValueError("Utterance has {} features per frame, the model takes {}".format(f, self.num_feats))
+            if t < min_frames:
+                raise ValueError("Utterance of {} frames is shorter than the {} frames the model "
+                                 "needs".format(t, min_frames))
+
+    def _next_batch(self):
+        batch = [self.pending.get()]
+        num_utterances = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while num_utterances < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            num_utterances += len(item[0])
+        return batch
+
+    def _batch_loop(self):
+        while True:
+            batch = self._next_batch()
+            utterances = [u for request_utterances, _ in batch for u in request_utterances]
+            try:
+                embeddings = self.embedding_processor(utterances).numpy()
+            except Exception:
+                self.logger.exception("Embedding batch of {} utterances failed, retrying its {} requests "
+                                      "one at a time".format(len(utterances), len(batch)))
+                self._embed_each(batch)
+                continue
+
+            self.logger.debug("Embedded %s utterances from %s requests", len(utterances), len(batch))
+            offset = 0
+            for request_utterances, future in batch:
+                future.set_result(embeddings[offset:offset + len(request_utterances)])
+                offset += len(request_utterances)
+
+    def _embed_each(self, batch):
+        for request_utterances, future in batch:
+            try:
+                future.set_result(self.embedding_processor(request_utterances).numpy())
+            except Exception as e:
+                future.set_exception(e)
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        batcher.start()
+
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, _EmbeddingRequestHandler)
+        server.daemon_threads = True
+        server.embedding_server = self
+        self.logger.info("Serving embeddings on {}".format(self.socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+class RemoteSpeakerEmbeddingProcessor:
+    """ Drop-in replacement for SpeakerEmbeddingProcessor that embeds through an EmbeddingServer """
+
+    def __init__(self, socket_path, timeout=30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+    def _request(self, utterances):
+        _send_utterances(self.sock, utterances)
+        status, rows, cols = _RESPONSE.unpack(_recv_exact(self.sock, _RESPONSE.size))
+        if status != STATUS_OK:
+            raise RuntimeError("Embedding server error: {}".format(_recv_exact(self.sock, rows).decode('utf-8')))
+        data = _recv_exact(self.sock, 4 * rows * cols)
+        return np.frombuffer(data, dtype='<f4').reshape(rows, cols)
+
+    def forward(self, spect_batch):
+        utterances = [u.numpy() if isinstance(u, torch.Tensor) else u for u in spect_batch]
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = self._connect()
+                embeddings = self._request(utterances)
+            except (OSError, EOFError):
+                # The server may have restarted, retry once on a fresh connection
+                if self.sock is not None:
+                    self.sock.close()
+                self.sock = self._connect()
+                embeddings = self._request(utterances)
+        return torch.from_numpy(embeddings)
+
+    def share_memory(self):
+        pass
+
+    def __call__(self, spect_batch):
+        return self.forward(spect_batch)
+
+
+@gin.configurable
+def get_embedding_processor(server_path=None, **kwargs):
+    """ Embedding processor for a caller: a client of the server at server_path if one is
+    configured, otherwise a local SpeakerEmbeddingProcessor built with kwargs """
+    if server_path:
+        return RemoteSpeakerEmbeddingProcessor(server_path)
+    return SpeakerEmbeddingProcessor(**kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="processor/config/prod.gin")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    gin.parse_config_file(args.config, skip_unknown=True)
+
+    EmbeddingServer().serve_forever()
@@ -0,0 +1,139 @@
+import argparse
+import copy
+import json
+import logging
+import gin
+import torch
+import torch.nn as nn
+from processor.speaker_embedding_processor import SpeakerEmbeddingProcessor, METADATA_FILE
+
+
+class EmbeddingOnly(nn.Module):
+    """ Specialises a speaker model's forward to em=True so it can be traced.
+    With masked unset the lengths are ignored and pooling covers every frame. """
+
+    def __init__(self, model, masked=True):
+        super(EmbeddingOnly, self).__init__()
+        self.model = model
+        self.masked = masked
+
+    def forward(self, x, lengths):
+        return self.model([x, lengths if self.masked else None], em=True)
+
+
+def fold_conv_bn(conv, bn):
+    """ Fold an eval-mode BatchNorm2d into the preceding Conv2d
+
+    :return: Conv2d with bias equivalent to bn(conv(x))
+    """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    with torch.no_grad():
+        folded.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        folded.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return folded
+
+
+def fold_batch_norm(module):
+    """ Fold every Conv2d + BatchNorm2d pair in place
+
+    Pairs are adjacent layers of an nn.Sequential or sibling attributes named
+    convN / bnN (as in BasicBlock5x5). Folded BatchNorm layers become nn.Identity.
+    """
+    children = module._modules
+    names = list(children.keys())
+
+    if isinstance(module, nn.Sequential):
+        pairs = zip(names[:-1], names[1:])
+    else:
+        pairs = [("conv" + name[2:], name) for name in names if name.startswith("bn")]
+
+    for conv_name, bn_name in pairs:
+        conv, bn = children.get(conv_name), children.get(bn_name)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            children[conv_name] = fold_conv_bn(conv, bn)
+            children[bn_name] = nn.Identity()
+
+    for child in children.values():
+        if child is not None:
+            fold_batch_norm(child)
+
+    return module
+
+
+def check_parity(model, scripted, lengths=(150, 301, 777), num_feats=64, tol=1e-4):
+    """ Compare embeddings of the eager model and the exported model on zero-padded
+    batches of several lengths
+
+    :raises RuntimeError: if the relative difference of any batch exceeds tol
+    """
+    for length in lengths:
+        seq_lens = torch.LongTensor([length, length - 37, length // 2])
+        x = torch.randn(len(seq_lens), 1, length, num_feats)
+        for i, l in enumerate(seq_lens):
+            x[i, :, l:] = 0
+        with torch.no_grad():
+            expected = model([x, seq_lens], em=True)
+            actual = scripted(x, seq_lens)
+        err = ((expected - actual).norm() / expected.norm()).item()
+        logging.info("Parity at {} frames: relative error {}".format(length, err))
+        if err > tol:
+            raise RuntimeError("Exported model diverges from eager model at {} frames "
+                               "(relative error {})".format(length, err))
+
+
+def trace_and_freeze(module, example_frames=300, num_feats=64):
+    """ :return: frozen TorchScript module traced from a ((N, 1, T, F), (N,)) -> (N, D) module """
+    example = (torch.randn(2, 1, example_frames, num_feats), torch.LongTensor([example_frames, example_frames // 2]))
+    with torch.no_grad():
+        scripted = torch.jit.trace(module, example)
+    return torch.jit.freeze(scripted)
+
+
+def export_scripted_model(model, example_frames=300, num_feats=64):
+    """ Trace and freeze the embedding path of an eager speaker model
+
+    :param model: speaker model with loaded parameters
+    :return: frozen TorchScript module mapping (N, 1, T, F) features and (N,) lengths to (N, D)
+    """
+    model.eval()
+    folded = EmbeddingOnly(fold_batch_norm(copy.deepcopy(model))).eval()
+    scripted = trace_and_freeze(folded, example_frames, num_feats)
+    check_parity(model, scripted, num_feats=num_feats)
+    return scripted
+
+
+def save_scripted_model(scripted, path, masked=True, min_frames=None):
+    """ Save an exported model with the metadata ScriptedSpeakerEmbeddingInference reads
+
+    :param masked: whether the model pools over the given lengths only. Unmasked models
+        are served one utterance at a time since padding would change their embeddings.
+    :param min_frames: shortest utterance the model can embed (its eager model's
+        min_frames), checked before inference since the traced model cannot
+    """
+    metadata = {"masked": masked, "min_frames": min_frames}
+    torch.jit.save(scripted, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="processor/config/prod.gin")
+    parser.add_argument("--output", type=str, default="models/verification/baseline_mel_scripted.pt")
+    parser.add_argument("--checkpoint-output", type=str, default=None,
+                        help="also re-save the eager checkpoint in the zipfile format used by mmap_weights")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    gin.parse_config_file(args.config, skip_unknown=True)
+
+    # Always export from the eager checkpoint at SpeakerEmbeddingProcessor.checkpoint_path
+    embedding_processor = SpeakerEmbeddingProcessor(scripted_path=None)
+    scripted = export_scripted_model(embedding_processor.embedding_model)
+    save_scripted_model(scripted, args.output, min_frames=embedding_processor.embedding_model.min_frames)
+    logging.info("Saved scripted embedding model to {}".format(args.output))
+
+    if args.checkpoint_output:
+        torch.save({"model": embedding_processor.embedding_model.state_dict()}, args.checkpoint_output)
+        logging.info("Saved mmap-able checkpoint to {}".format(args.checkpoint_output))
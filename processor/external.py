@@ -1,4 +1,4 @@
-from processor.speaker_embedding_processor import SpeakerEmbeddingProcessor
+from processor.embedding_server import get_embedding_processor
 from processor.audio_processor import AudioProcessor
 import torch.utils.data
 import numpy as np
@@ -26,7 +26,7 @@ def collate(batch):
 def embeddings_from_wav_set(wav_file_paths):
     batch_size = 64
 
-    get_embeddings = SpeakerEmbeddingProcessor(use_gpu=True)
+    get_embeddings = get_embedding_processor(use_gpu=True)
     audio_processor = AudioProcessor()
 
     dset = WavInferenceDataSet(wav_file_paths, audio_processor)
@@ -0,0 +1,167 @@
+""" Log mel filterbank energies as speechpy.feature.lmfe computes them, for whole signals
+and for audio that arrives a chunk at a time.
+
+speechpy builds the mel filterbank again on every call; here it is built once per sample
+rate. Frames are rectangular windowed and zero padded to fft_length, and the last
+complete frame is dropped, as in speechpy, so both paths give the same features.
+
+DeepSpeechMFCC derives the MFCC input of presence detection from the same power
+spectrum, so a request needs only one STFT.
+"""
+import numpy as np
+import speechpy
+from scipy.fftpack import dct
+
+
+class LogMelFrontend:
+
+    def __init__(self, num_filters=64, frame_length=0.020, frame_stride=0.01, fft_length=512):
+        self.num_filters = num_filters
+        self.frame_length = frame_length
+        self.frame_stride = frame_stride
+        self.fft_length = fft_length
+        self._filterbanks = {}
+
+    def frame_sizes(self, fs):
+        """ :return: (samples per frame, samples between frame starts) at sample rate fs """
+        return int(np.round(fs * self.frame_length)), int(np.round(fs * self.frame_stride))
+
+    def num_frames(self, n_samples, fs):
+        frame_size, stride = self.frame_sizes(fs)
+        return max(0, (n_samples - frame_size) // stride)
+
+    def filterbank(self, fs):
+        if fs not in self._filterbanks:
+            self._filterbanks[fs] = speechpy.feature.filterbanks(self.num_filters, self.fft_length // 2 + 1, fs, 0, None)
+        return self._filterbanks[fs]
+
+    def frames(self, signal, fs, n):
+        """ :return: (n, frame size) view of the first n frames of signal """
+        frame_size, stride = self.frame_sizes(fs)
+        signal = np.ascontiguousarray(signal, dtype=np.float64)
+        return np.lib.stride_tricks.as_strided(signal, shape=(n, frame_size),
+                                               strides=(stride * signal.strides[0], signal.strides[0]),
+                                               writeable=False)
+
+    def power_spectrum(self, frames):
+        """ :return: (n frames, fft_length // 2 + 1) periodogram of each frame """
+        spectrum = np.absolute(np.fft.rfft(frames, n=self.fft_length, axis=-1))
+        return np.square(spectrum) / self.fft_length
+
+    def log_mel(self, power, fs):
+        """ :return: (n frames, num_filters) log mel energies of a power spectrum """
+        energies = np.dot(power, self.filterbank(fs).T)
+        return np.log(np.where(energies == 0, np.finfo(float).eps, energies))
+
+    def log_energies(self, frames, fs):
+        return self.log_mel(self.power_spectrum(frames), fs)
+
+    def power(self, signal, fs):
+        """ :return: power spectrum of every frame lmfe would use """
+        return self.power_spectrum(self.frames(signal, fs, self.num_frames(len(signal), fs)))
+
+    def __call__(self, signal, fs):
+        """ speechpy.feature.lmfe(signal, fs, num_filters=num_filters) """
+        return self.log_mel(self.power(signal, fs), fs)
+
+
+class DeepSpeechMFCC:
+    """ The features presence_detection.speech_rec computes with
+    python_speech_features.mfcc, taken from a LogMelFrontend power spectrum
+
+    speech_rec frames a pre-emphasized signal in 25 ms frames of its own. Here the frames
+    are the frontend's 20 ms ones and pre-emphasis is applied as its gain per frequency
+    bin, so the features are close to, but not the same as, the ones DeepSpeech was
+    trained on. fft_length must match the frontend's.
+    """
+
+    def __init__(self, numcep=26, num_filters=26, fft_length=512, preemph=0.97, ceplifter=22):
+        self.numcep = numcep
+        self.num_filters = num_filters
+        self.fft_length = fft_length
+        self.ceplifter = ceplifter
+        omega = 2 * np.pi * np.arange(fft_length // 2 + 1) / fft_length
+        self.emphasis = 1 + preemph ** 2 - 2 * preemph * np.cos(omega)
+        n = np.arange(numcep)
+        self.lifter = 1 + (ceplifter / 2.0) * np.sin(np.pi * n / ceplifter) if ceplifter > 0 else np.ones(numcep)
+        self._filterbanks = {}
+
+    def filterbank(self, fs):
+        if fs not in self._filterbanks:
+            # Only needed with presence detection, like the rest of its dependencies
+            from python_speech_features import get_filterbanks
+            self._filterbanks[fs] = get_filterbanks(self.num_filters, self.fft_length, fs, 0, None)
+        return self._filterbanks[fs]
+
+    def __call__(self, power, fs):
+        """ :return: (n frames, numcep) MFCCs with the log frame energy as the first """
+        power = power * self.emphasis
+        energy = np.sum(power, axis=1)
+        energy = np.where(energy == 0, np.finfo(float).eps, energy)
+        features = np.dot(power, self.filterbank(fs).T)
+        features = np.log(np.where(features == 0, np.finfo(float).eps, features))
+        features = dct(features, type=2, axis=1, norm='ortho')[:, :self.numcep] * self.lifter
+        features[:, 0] = np.log(energy)
+        return features
+
+
+def voiced_range(log_energies, margin_db=40, padding=0):
+    """ Locate speech by the loudest filter of each frame, as data/processing/bulk_audio.VAD
+    does, but relative to the loudest frame so that it does not depend on the gain
+
+    :param log_energies: (frames, filters) log mel energies
+    :return: (first, last + 1) frames from the first to the last frame within margin_db of
+        the loudest frame, widened by padding frames on either side
+    """
+    loudest = log_energies.max(axis=1)
+    voiced = np.flatnonzero(loudest > loudest.max() - margin_db * np.log(10) / 10)
+    return max(0, voiced[0] - padding), min(len(loudest), voiced[-1] + 1 + padding)
+
+
+class IncrementalLogMel:
+    """ Featurizes a signal as its samples arrive, keeping only the samples of frames
+    that are not complete yet. finish() returns what LogMelFrontend would have returned
+    for the whole signal. """
+
+    def __init__(self, frontend, fs, mfcc=None):
+        """
+        :param mfcc: DeepSpeechMFCC to also compute presence detection features with
+        """
+        self.frontend = frontend
+        self.fs = fs
+        self.mfcc = mfcc
+        self.frame_size, self.stride = frontend.frame_sizes(fs)
+        self._pending = np.zeros(0)
+        # Index of the first pending sample in the whole signal
+        self._offset = 0
+        self._features = []
+        self._mfcc = []
+        self.frames_done = 0
+
+    def feed(self, samples):
+        """ :param samples: float samples following those fed so far """
+        self._pending = np.concatenate((self._pending, samples))
+        total = self._offset + len(self._pending)
+        # speechpy never emits the last complete frame, so wait for one more stride
+        ready = self.frontend.num_frames(total, self.fs) - self.frames_done
+        if ready <= 0:
+            return
+
+        start = self.frames_done * self.stride - self._offset
+        power = self.frontend.power_spectrum(self.frontend.frames(self._pending[start:], self.fs, ready))
+        self._features.append(self.frontend.log_mel(power, self.fs))
+        if self.mfcc is not None:
+            self._mfcc.append(self.mfcc(power, self.fs))
+        self.frames_done += ready
+
+        consumed = self.frames_done * self.stride - self._offset
+        self._pending = self._pending[consumed:]
+        self._offset += consumed
+
+    def finish(self):
+        """ :return: ((frames, num_filters) log mel energies, (frames, numcep) MFCCs or
+        None without mfcc) """
+        if not self.frames_done:
+            raise ValueError("Too little audio for a single frame")
+        mfcc = np.concatenate(self._mfcc, axis=0) if self.mfcc is not None else None
+        return np.concatenate(self._features, axis=0), mfcc
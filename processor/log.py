@@ -0,0 +1,113 @@
+""" Processor logging off the request path.
+
+Records are put on an in-memory queue by the calling thread and formatted and written
+by a background listener, so a log call costs a record allocation and a queue put.
+Messages are formatted lazily in the listener: pass values as arguments
+(logger.info("Decision %s", username)) rather than formatting them at the call site,
+and do not mutate those arguments after logging them.
+
+Every record carries the id of the request being processed by the calling thread
+(see request_context) and is written as one JSON object per line.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from contextlib import contextmanager
+import gin
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+_listener = None
+
+
+@contextmanager
+def request_context(request_id):
+    """ Tag every record logged in this context with request_id """
+    token = _request_id.set(request_id)
+    try:
+        yield
+    finally:
+        _request_id.reset(token)
+
+
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + ".%03d" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "process": record.process,
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ QueueHandler that leaves formatting to the listener thread.
+
+    The stock handler merges the message arguments and renders tracebacks in the calling
+    thread so records can be pickled. The queue here never leaves the process, so the
+    record is enqueued as is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+@gin.configurable
+def setup_logging(filename='yolo_processor.log', level=logging.INFO, json_format=True):
+    """ Route all logging through a queue to a background writer for filename
+
+    Safe to call again, e.g. in a forked worker whose listener thread did not survive
+    the fork; the previous listener is stopped first.
+    """
+    global _listener
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except RuntimeError:
+            pass
+
+    file_handler = logging.FileHandler(filename, mode='a')
+    if json_format:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s,%(msecs)d %(name)s %(levelname)s '
+                                                    '[%(request_id)s] %(message)s', datefmt='%H:%M:%S'))
+
+    records = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(records)
+    queue_handler.addFilter(RequestIdFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    return _listener
+
+
+@atexit.register
+def _flush():
+    if _listener is not None:
+        try:
+            _listener.stop()
+        except RuntimeError:
+            pass
@@ -0,0 +1,250 @@
+""" In-process metrics for the processor, rendered in the Prometheus text format.
+
+Recording a sample is a perf_counter call, a bisect and a locked increment. Rendering
+(on scrape or push) is the only place that formats text.
+"""
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gin
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            series = list(self.series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return ["{}{} {}".format(self.name, _format_labels(self.label_names, key), value)]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def _render_series(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(self.label_names, key, [("le", le)]),
+                                                 cumulative))
+        labels = _format_labels(self.label_names, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, count))
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kwargs):
+        return self._add(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self._add(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self._add(Histogram(*args, **kwargs))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """ collector() is called before every render, e.g. to sample a gauge """
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logging.getLogger('metrics').exception("Metrics collector failed")
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram("yolo_stage_seconds", "Time spent in each processing stage",
+                                   ("stage", "request_type"))
+REQUEST_SECONDS = REGISTRY.histogram("yolo_request_seconds", "Time to process a request",
+                                     ("request_type",))
+QUEUE_DEPTH = REGISTRY.gauge("yolo_queue_depth", "Requests waiting in a queue", ("queue",))
+CACHE_LOOKUPS = REGISTRY.counter("yolo_cache_lookups_total", "Cache lookups by result", ("cache", "result"))
+EXPIRED = REGISTRY.counter("yolo_requests_expired_total", "Requests dropped after their deadline",
+                           ("request_type",))
+
+_context = threading.local()
+
+
+@contextmanager
+def request_context(request_type):
+    """ Label every stage timed in this thread with request_type and time the whole request """
+    _context.request_type = request_type
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, request_type=request_type)
+        _context.request_type = None
+
+
+@contextmanager
+def stage_labels(request_type):
+    """ Label every stage timed in this thread with request_type, for the part of a
+    request that runs on another thread. Nests inside request_context on the same thread. """
+    previous = current_request_type()
+    _context.request_type = request_type
+    try:
+        yield
+    finally:
+        _context.request_type = previous
+
+
+def current_request_type():
+    return getattr(_context, "request_type", None)
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage,
+                              request_type=current_request_type() or "none")
+
+
+def cache_lookup(cache, hit):
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@gin.configurable
+class MetricsExporter:
+    """ Serves REGISTRY on http://host:(port + worker)/metrics and optionally pushes the
+    rendered text to the redis hash metrics_key (one field per worker) every push_interval
+    seconds """
+
+    def __init__(self, worker=0, redis_conn=None, enabled=True, host="127.0.0.1", port=9310,
+                 push_interval=None, metrics_key="metrics", registry=REGISTRY):
+        self.worker = worker
+        self.redis_conn = redis_conn
+        self.enabled = enabled
+        self.host = host
+        self.port = port + worker
+        self.push_interval = push_interval
+        self.metrics_key = metrics_key
+        self.registry = registry
+        self.logger = logging.getLogger('metrics')
+
+    def start(self):
+        if not self.enabled:
+            return
+        try:
+            server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        except OSError:
+            # Metrics are not worth a worker, carry on without the endpoint
+            self.logger.exception("Could not serve metrics on {}:{}".format(self.host, self.port))
+        else:
+            server.daemon_threads = True
+            server.registry = self.registry
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.logger.info("Serving metrics on http://{}:{}/metrics".format(self.host, self.port))
+
+        if self.push_interval and self.redis_conn is not None:
+            threading.Thread(target=self._push_loop, daemon=True).start()
+
+    def _push_loop(self):
+        while True:
+            time.sleep(self.push_interval)
+            try:
+                self.redis_conn.hset(self.metrics_key, "worker:{}".format(self.worker), self.registry.render())
+            except Exception:
+                self.logger.exception("Pushing metrics to redis failed")
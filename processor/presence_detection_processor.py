@@ -1,13 +1,15 @@
 import gin
 import numpy as np
-from presence_detection.speech_rec import SpeechRec
-from presence_detection.fb import PresenceScore
 import logging
 
 @gin.configurable
 class PresenceDetectionProcessor:
 
     def __init__(self, threshold):
+        # TensorFlow is only imported once presence detection is actually used
+        from presence_detection.speech_rec import SpeechRec
+        from presence_detection.fb import PresenceScore
+
         gin.parse_config_file("presence_detection/config/presence_detection.gin")
         self.speech_rec_model = SpeechRec()
         self.presence_model = PresenceScore()
@@ -20,14 +22,19 @@ class PresenceDetectionProcessor:
         filtered_text = " ".join(filtered_text.split())
         return filtered_text
 
-    def forward(self, ground_truth, audio, fs):
-        log_probs = self.speech_rec_model.forward(audio, fs, display_chars=False)
+    def forward(self, ground_truth, audio, fs, mfcc=None, cancel=None):
+        """ :param mfcc: speech recognition features already computed by AudioProcessor
+        :param cancel: threading.Event set once the result is no longer needed, which
+            stops speech recognition early and returns False """
+        log_probs = self.speech_rec_model.forward(audio, fs, display_chars=False, features=mfcc, cancel=cancel)
+        if cancel is not None and cancel.is_set():
+            return False
         chars = self.speech_rec_model.alphabet._label_to_str + ["-"]
 
         ground_truth = self._filter(ground_truth.lower())
 
         score = self.presence_model.forward(ground_truth, log_probs, chars)
-        self.logger.info("Presence detection of gt {} is {}".format(ground_truth, score))
+        self.logger.info("Presence detection of gt %s is %s", ground_truth, score)
         return score > self.threshold
 
     def __call__(self, *args, **kwargs):
@@ -0,0 +1,155 @@
+import argparse
+import copy
+import json
+import logging
+import time
+import gin
+import numpy as np
+import torch
+import torch.nn as nn
+import data.voxceleb.voxceleb as voxceleb
+from training.speaker_verification.verify import VerificationEvaluator
+from processor.speaker_embedding_processor import SpeakerEmbeddingProcessor, process_data_batch
+from processor.export import EmbeddingOnly, fold_batch_norm, trace_and_freeze, save_scripted_model
+
+
+class ScriptedEmbeddingModel(nn.Module):
+    """ Gives an exported ((N, 1, T, F), (N,)) -> (N, D) module the forward signature of
+    the speaker models so VerificationEvaluator can score it """
+
+    def __init__(self, scripted, embedding_size):
+        super(ScriptedEmbeddingModel, self).__init__()
+        self.scripted = scripted
+        self.embedding_size = embedding_size
+
+    def forward(self, xs, em=True):
+        x, seq_lens = xs
+        return self.scripted(x, torch.LongTensor(seq_lens))
+
+
+def load_calibration_batches(processed_root, n=256, batch_size=16, max_frames=1000):
+    """ Sample preprocessed VoxCeleb utterances for static quantization calibration
+
+    :return: list of ((N, 1, T, F), (N,)) batches
+    """
+    paths = voxceleb.get_all_data_file_paths(processed_root)
+    idxs = np.arange(len(paths))
+    np.random.shuffle(idxs)
+
+    utterances = []
+    for i in idxs[:n]:
+        u = voxceleb.voxceleb_sample_normalize(torch.FloatTensor(np.load(paths[i])))
+        utterances.append(u[:max_frames].numpy())
+
+    batches = []
+    for i in range(0, len(utterances), batch_size):
+        seq_batch, seq_lens = process_data_batch(utterances[i:i + batch_size], mode="wrap")
+        batches.append((seq_batch, torch.LongTensor(seq_lens)))
+    return batches
+
+
+def quantize_dynamic(model):
+    """ int8 weights with dynamically quantized activations for the Linear layers """
+    model = EmbeddingOnly(fold_batch_norm(copy.deepcopy(model))).eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static(model, calibration_batches, backend='fbgemm'):
+    """ int8 weights and activations, with activation ranges observed on calibration_batches
+
+    The masked pooling path is not symbolically traceable, so the static model pools over
+    every frame, padding included. It is saved as unmasked and served one utterance at a
+    time.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    model = EmbeddingOnly(fold_batch_norm(copy.deepcopy(model)), masked=False).eval()
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), calibration_batches[0])
+    with torch.no_grad():
+        for seq_batch, seq_lens in calibration_batches:
+            prepared(seq_batch, seq_lens)
+    return convert_fx(prepared)
+
+
+def measure_latency(model, batch_size=1, frames=500, num_feats=64, repeats=20):
+    """ :return: mean seconds per forward of a (batch_size, 1, frames, num_feats) batch """
+    x = torch.randn(batch_size, 1, frames, num_feats)
+    seq_lens = torch.full((batch_size,), frames, dtype=torch.long)
+    with torch.no_grad():
+        model(x, seq_lens)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(x, seq_lens)
+    return (time.perf_counter() - start) / repeats
+
+
+def compare(reference, candidate, evaluator, embedding_size):
+    """ Latency and EER of a quantized candidate relative to the float reference
+
+    :param reference: frozen float model, ((N, 1, T, F), (N,)) -> (N, D)
+    :param candidate: frozen quantized model, ((N, 1, T, F), (N,)) -> (N, D)
+    :return: report dict
+    """
+    reference_latency = measure_latency(reference)
+    candidate_latency = measure_latency(candidate)
+    reference_eer = float(evaluator.evaluate(ScriptedEmbeddingModel(reference, embedding_size)))
+    candidate_eer = float(evaluator.evaluate(ScriptedEmbeddingModel(candidate, embedding_size)))
+    return {
+        "reference_latency": reference_latency,
+        "candidate_latency": candidate_latency,
+        "latency_delta": candidate_latency - reference_latency,
+        "reference_eer": reference_eer,
+        "candidate_eer": candidate_eer,
+        "eer_delta": candidate_eer - reference_eer,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="processor/config/prod.gin")
+    parser.add_argument("--mode", type=str, default="static", help="static or dynamic")
+    parser.add_argument("--calibration-path", type=str, default="/home/rbrigden/voxceleb/processed")
+    parser.add_argument("--num-calibration", type=int, default=256)
+    parser.add_argument("--voxceleb-test-path", type=str, default="/home/rbrigden/voxceleb/test/processed")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="largest absolute EER increase allowed for promotion")
+    parser.add_argument("--output", type=str, default="models/verification/baseline_mel_int8.pt")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    gin.parse_config_file(args.config, skip_unknown=True)
+
+    model = SpeakerEmbeddingProcessor(scripted_path=None).embedding_model
+    model.eval()
+
+    if args.mode == "static":
+        calibration_batches = load_calibration_batches(args.calibration_path, n=args.num_calibration)
+        quantized = quantize_static(model, calibration_batches)
+        masked = False
+    elif args.mode == "dynamic":
+        quantized = quantize_dynamic(model)
+        masked = True
+    else:
+        raise ValueError("Invalid mode specified")
+
+    # Gate against a float model that pools the same way, so the EER delta is down to
+    # quantization alone
+    reference = trace_and_freeze(EmbeddingOnly(fold_batch_norm(copy.deepcopy(model)), masked=masked).eval())
+    candidate = trace_and_freeze(quantized)
+
+    evaluator = VerificationEvaluator(args.voxceleb_test_path, use_gpu=False)
+    report = compare(reference, candidate, evaluator, model.embedding_size)
+    report["mode"] = args.mode
+    report["tolerance"] = args.tolerance
+    report["promoted"] = report["eer_delta"] <= args.tolerance
+    print(json.dumps(report, indent=2))
+
+    if not report["promoted"]:
+        logging.error("EER regression {} exceeds tolerance {}, not promoting".format(report["eer_delta"],
+                                                                                    args.tolerance))
+        raise SystemExit(1)
+
+    save_scripted_model(candidate, args.output, masked=masked, min_frames=model.min_frames)
+    logging.info("Promoted quantized embedding model to {}".format(args.output))
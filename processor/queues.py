@@ -0,0 +1,325 @@
+""" Request lanes shared by the web server and the processor.
+
+Each request type has its own redis list. Workers pop the lanes in priority order, so
+authentications are always served before registrations (which retrain every speaker
+model). The web server stamps each request with an absolute "deadline" (unix seconds);
+requests popped after their deadline are answered with a timeout result instead of
+being processed.
+
+In reliable mode (redis >= 6.2) a popped request is atomically moved onto the worker's
+processing:{worker} list and timestamped in inflight:{worker} until it is acknowledged.
+Workers refresh heartbeat:{worker} while they are alive. Any worker periodically reaps
+requests of workers whose heartbeat expired, and requests in flight for longer than
+visibility_timeout, by pushing them back onto the head of their lane. A request that
+has been requeued max_attempts times is answered with a failure result instead.
+
+Results expire after result_ttl seconds and a request's audio is deleted once it has
+been answered.
+
+A streamed request (with "stream": true) is queued on STREAM_LANE as soon as the client
+starts recording. Its framed audio is pushed in pieces onto the list stream:{id} as it
+arrives, followed by an empty item once the recording ends, so the worker that pops it
+featurizes while the user is still speaking. The worker is busy for as long as the user
+speaks, so streams are served by threads of their own (see pop_stream) and are cut off
+after max_stream_seconds or max_stream_bytes. Streamed requests cannot be replayed and
+are failed instead of requeued.
+
+The web server claims a registration's username in the USERNAMES_KEY set when it
+queues the request; a registration that fails before its user is committed gives its
+name back.
+"""
+import json
+import logging
+import threading
+import time
+import gin
+
+LANES = {
+    "authenticate": "queue:requests:authenticate",
+    "register": "queue:requests:register",
+}
+
+# Highest priority first
+PRIORITY = ("authenticate", "register")
+
+# Streamed logins, popped only by stream workers
+STREAM_LANE = "queue:requests:stream"
+# Ends a stream the client gave up on (see app/login/queues.py)
+STREAM_ABORT = b"abort"
+
+TIMEOUT_RESULT = {"username": None, "error": "timeout"}
+FAILED_RESULT = {"username": None, "error": "failed"}
+
+USERNAMES_KEY = "usernames"
+WORKERS_KEY = "workers"
+REAPER_LOCK_KEY = "reaper:lock"
+
+# KEYS: processing list, inflight hash, lanes in priority order. ARGV: current time
+_RELIABLE_POP = """
+for i = 3, #KEYS do
+    local item = redis.call('LMOVE', KEYS[i], KEYS[1], 'LEFT', 'RIGHT')
+    if item then
+        redis.call('HSET', KEYS[2], item, ARGV[1])
+        return item
+    end
+end
+return false
+"""
+
+
+def lane(request_type):
+    return LANES[request_type]
+
+
+def expired(request, now=None):
+    deadline = request.get("deadline")
+    return deadline is not None and (now or time.time()) > deadline
+
+
+class StreamAborted(Exception):
+    """ The client abandoned a streamed request and no longer waits for its result """
+
+
+def stream_key(request_id):
+    return "stream:{}".format(request_id)
+
+
+def stream_bytes_key(request_id):
+    return "stream:{}:bytes".format(request_id)
+
+
+@gin.configurable
+class RequestQueue:
+
+    def __init__(self, redis_conn, block_timeout=30, reliable=False, poll_timeout=1, heartbeat_ttl=15,
+                 visibility_timeout=600, max_attempts=3, reap_interval=10, result_ttl=300, stream_timeout=10,
+                 max_stream_seconds=30, max_stream_bytes=4 * 1024 * 1024, is_registered=None):
+        """
+        :param poll_timeout: in reliable mode, seconds to block on the authenticate lane
+            before checking the lower priority lanes again
+        :param visibility_timeout: seconds a request may stay in flight before it is
+            handed to another worker; must exceed the slowest registration
+        :param stream_timeout: seconds to wait for the next piece of a streamed request's
+            audio before failing it
+        :param max_stream_seconds: seconds a streamed request may take in total
+        :param max_stream_bytes: most audio a streamed request may send
+        :param is_registered: username -> whether the user is committed; a failed
+            registration keeps its name claimed if so
+        """
+        self.redis_conn = redis_conn
+        self.block_timeout = block_timeout
+        self.reliable = reliable
+        self.poll_timeout = poll_timeout
+        self.heartbeat_ttl = heartbeat_ttl
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.reap_interval = reap_interval
+        self.result_ttl = result_ttl
+        self.stream_timeout = stream_timeout
+        self.max_stream_seconds = max_stream_seconds
+        self.max_stream_bytes = max_stream_bytes
+        self.is_registered = is_registered
+        self.keys = [LANES[request_type] for request_type in PRIORITY]
+        self.worker_id = None
+        self._raw = {}
+        self.logger = logging.getLogger('requestQueue')
+
+    def start(self, worker_id):
+        """ Register this worker and, in reliable mode, start its heartbeat and reaper """
+        self.worker_id = worker_id
+        if not self.reliable:
+            return
+        self._pop_script = self.redis_conn.register_script(_RELIABLE_POP)
+        self._heartbeat()
+        self.redis_conn.sadd(WORKERS_KEY, worker_id)
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+        threading.Thread(target=self._reap_loop, daemon=True).start()
+
+    def _processing_key(self, worker_id):
+        return "processing:{}".format(worker_id)
+
+    def _inflight_key(self, worker_id):
+        return "inflight:{}".format(worker_id)
+
+    def _heartbeat_key(self, worker_id):
+        return "heartbeat:{}".format(worker_id)
+
+    def pop(self):
+        """ :return: the next request dict from the highest priority non-empty lane, or
+        None if no request arrived while blocking """
+        if self.reliable:
+            raw = self._pop_reliable()
+        else:
+            item = self.redis_conn.blpop(self.keys, self.block_timeout)
+            raw = item[1] if item else None
+        if raw is None:
+            return None
+
+        request = json.loads(raw.decode('utf-8'))
+        if self.reliable:
+            self._raw[request["id"]] = raw
+        return request
+
+    def pop_stream(self):
+        """ :return: the next streamed request, or None if none arrived while blocking
+
+        Streams are not moved to the processing list: they cannot be replayed, and the
+        client gives up at the request's deadline if the worker dies.
+        """
+        item = self.redis_conn.blpop([STREAM_LANE], self.block_timeout)
+        return json.loads(item[1].decode('utf-8')) if item else None
+
+    def _pop_reliable(self):
+        processing = self._processing_key(self.worker_id)
+        inflight = self._inflight_key(self.worker_id)
+        raw = self._pop_script(keys=[processing, inflight] + self.keys, args=[time.time()])
+        if raw is not None:
+            return raw
+
+        # Nothing queued: block on the highest priority lane only, BLMOVE takes one source
+        raw = self.redis_conn.blmove(self.keys[0], processing, self.poll_timeout, "LEFT", "RIGHT")
+        if raw is not None:
+            self.redis_conn.hset(inflight, raw, time.time())
+        return raw
+
+    def ack(self, request):
+        """ Mark request as answered and drop its audio """
+        pipe = self.redis_conn.pipeline()
+        raw = self._raw.pop(request["id"], None)
+        if raw is not None:
+            pipe.lrem(self._processing_key(self.worker_id), 1, raw)
+            pipe.hdel(self._inflight_key(self.worker_id), raw)
+        pipe.delete("audio:{}".format(request["id"]), stream_key(request["id"]), stream_bytes_key(request["id"]))
+        pipe.execute()
+
+    def stream(self, request_id):
+        """ Yield the pieces of a streamed request's audio as the web server pushes them
+
+        :raises TimeoutError: if no piece arrives within stream_timeout seconds, or the
+            stream is still open after max_stream_seconds
+        :raises ValueError: if the stream exceeds max_stream_bytes
+        :raises StreamAborted: if the client gave up on the stream
+        """
+        key = stream_key(request_id)
+        give_up = time.time() + self.max_stream_seconds
+        received = 0
+        while True:
+            remaining = give_up - time.time()
+            if remaining <= 0:
+                raise TimeoutError("Stream {} still open after {} s".format(request_id, self.max_stream_seconds))
+            timeout = min(self.stream_timeout, max(1, int(remaining)))
+            item = self.redis_conn.blpop([key], timeout)
+            if item is None:
+                if time.time() >= give_up:
+                    continue
+                raise TimeoutError("No audio for request {} in {} s".format(request_id, timeout))
+            if not item[1]:
+                return
+            if item[1] == STREAM_ABORT:
+                raise StreamAborted("Stream {} aborted by the client".format(request_id))
+            received += len(item[1])
+            if received > self.max_stream_bytes:
+                raise ValueError("Stream {} exceeds {} bytes".format(request_id, self.max_stream_bytes))
+            yield item[1]
+
+    def write_result(self, request_id, result):
+        """ Store the result and wake any web worker subscribed to it """
+        key = "result:{}".format(request_id)
+        pipe = self.redis_conn.pipeline()
+        pipe.set(key, json.dumps(result), ex=self.result_ttl)
+        pipe.publish(key, 1)
+        pipe.execute()
+
+    def fail(self, request, result=FAILED_RESULT):
+        """ Answer request with an error result, releasing the username of a registration
+        that did not get as far as committing its user """
+        self.write_result(request["id"], result)
+        name = request.get("name") if request["type"] == "register" else None
+        if name and not (self.is_registered and self.is_registered(name)):
+            self.redis_conn.srem(USERNAMES_KEY, name)
+
+    def reject_expired(self, request):
+        """ Answer an expired request with a timeout result """
+        self.fail(request, TIMEOUT_RESULT)
+        self.ack(request)
+
+    def sync_usernames(self, usernames):
+        """ Add the usernames of registered users to the set the web server checks """
+        usernames = list(usernames)
+        for i in range(0, len(usernames), 1000):
+            self.redis_conn.sadd(USERNAMES_KEY, *usernames[i:i + 1000])
+
+    def depths(self):
+        """ :return: dict of request type (and "stream") to number of waiting requests """
+        pipe = self.redis_conn.pipeline()
+        for request_type in PRIORITY:
+            pipe.llen(LANES[request_type])
+        pipe.llen(STREAM_LANE)
+        return dict(zip(PRIORITY + ("stream",), pipe.execute()))
+
+    def _heartbeat(self):
+        self.redis_conn.set(self._heartbeat_key(self.worker_id), time.time(), ex=self.heartbeat_ttl)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_ttl / 3.0)
+            try:
+                self._heartbeat()
+            except Exception:
+                self.logger.exception("Heartbeat failed")
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                self.reap()
+            except Exception:
+                self.logger.exception("Reaping in-flight requests failed")
+
+    def reap(self):
+        """ Requeue the requests of dead workers and requests stuck in flight """
+        # One reaper at a time across all workers
+        if not self.redis_conn.set(REAPER_LOCK_KEY, self.worker_id, nx=True, ex=self.reap_interval):
+            return
+
+        now = time.time()
+        for worker_id in self.redis_conn.smembers(WORKERS_KEY):
+            worker_id = worker_id.decode('utf-8')
+            alive = self.redis_conn.exists(self._heartbeat_key(worker_id))
+            processing = self.redis_conn.lrange(self._processing_key(worker_id), 0, -1)
+            inflight = self.redis_conn.hgetall(self._inflight_key(worker_id))
+
+            for raw in processing:
+                if alive:
+                    # A live worker without a timestamp has only just moved the request
+                    started = inflight.get(raw)
+                    if started is None or now - float(started) < self.visibility_timeout:
+                        continue
+                self._requeue(worker_id, raw)
+
+            if not alive:
+                pipe = self.redis_conn.pipeline()
+                pipe.delete(self._processing_key(worker_id), self._inflight_key(worker_id))
+                pipe.srem(WORKERS_KEY, worker_id)
+                pipe.execute()
+                self.logger.warning("Reaped dead worker %s", worker_id)
+
+    def _requeue(self, worker_id, raw):
+        # The worker may acknowledge concurrently, only requeue what we removed
+        if not self.redis_conn.lrem(self._processing_key(worker_id), 1, raw):
+            return
+        self.redis_conn.hdel(self._inflight_key(worker_id), raw)
+
+        request = json.loads(raw.decode('utf-8'))
+        attempts = request.get("attempts", 0) + 1
+        if attempts >= self.max_attempts or request.get("stream"):
+            # The audio a streamed request's worker consumed is gone
+            self.logger.error("Giving up on %s request %s after %s attempts", request["type"], request["id"], attempts)
+            self.fail(request)
+            self.redis_conn.delete("audio:{}".format(request["id"]), stream_key(request["id"]),
+                                   stream_bytes_key(request["id"]))
+            return
+
+        request["attempts"] = attempts
+        self.redis_conn.lpush(LANES[request["type"]], json.dumps(request))
+        self.logger.warning("Requeued %s request %s from worker %s", request["type"], request["id"], worker_id)
@@ -1,25 +1,68 @@
-import torch
 import numpy as np
-import training.speaker_verification.eer as eer
-import sklearn.linear_model
 from collections import defaultdict
-import training.speaker_verification.model as models
-import redis
 from io import BytesIO
 import processor.db as db_core
+from processor import metrics
+from processor.connections import get_redis_conn
 import logging
 import gin
 
 
+class SpeakerModelRegistry:
+    """ Decoded speaker models for one classification mode.
+
+    Models are loaded from the database once and reloaded only after the version
+    counter in redis changes, which happens whenever update_speakers writes new models.
+    The usernames of the speakers are kept alongside for logging and results.
+    """
+
+    version_key = 'speaker_models:version'
+
+    def __init__(self, mode, redis_conn):
+        self.mode = mode
+        self.redis_conn = redis_conn
+        self._loaded = False
+        self._version = None
+        self._speaker_models = []
+        self.usernames = {}
+
+    def invalidate(self):
+        self.redis_conn.incr(self.version_key)
+
+    def get(self):
+        """ :return: list of (user_id, model, threshold) """
+        version = self.redis_conn.get(self.version_key)
+        hit = self._loaded and version == self._version
+        metrics.cache_lookup("speaker_models", hit)
+        if not hit:
+            self._speaker_models = db_core.load_speaker_models(self.mode)
+            self.usernames = db_core.load_usernames()
+            self._version = version
+            self._loaded = True
+        return self._speaker_models
+
+
+class _ByUsername:
+    """ (user_id, value) pairs that render with usernames only when a log record is written """
+
+    def __init__(self, pairs, usernames):
+        self.pairs = pairs
+        self.usernames = usernames
+
+    def __str__(self):
+        return str([(self.usernames.get(label, label), float(value)) for label, value in self.pairs])
+
+
 @gin.configurable
 class SpeakerClassificationProcessor:
 
     def __init__(self, mode='lr', decision_mode=False, fixed_thresh=None):
         self.mode = mode
         self.decision_mode = decision_mode
-        self.redis_conn = redis.Redis()
+        self.redis_conn = get_redis_conn()
         self.fixed_thresh = fixed_thresh
         self.logger = logging.getLogger('SpeakerClassificationProcessor')
+        self.registry = SpeakerModelRegistry(mode, self.redis_conn)
 
 
     def update_speakers(self):
@@ -33,6 +76,9 @@ class SpeakerClassificationProcessor:
 
         # TODO: Uses stats.npy to normalize the embeddings
 
+        # Training dependencies are not needed to classify, so import them on first use
+        import training.speaker_verification.eer as eer
+
         internal_emb = defaultdict(list)
 
 
@@ -47,7 +93,9 @@ class SpeakerClassificationProcessor:
         external_embeddings_train = external_embeddings[external_train_idxs[held_out_prop:]]
         external_embeddings_val = external_embeddings[external_train_idxs[:held_out_prop]]
 
+        users = {}
         for user in db_core.User.select():
+            users[user.id] = user
             for embedding in user.embeddings:
                 internal_emb[user.id].append(db_core.load_embedding_data(embedding, dtype=np.float64))
 
@@ -85,12 +133,14 @@ class SpeakerClassificationProcessor:
             svm_eer, svm_threshold = eer.EER(svm_eer_labels, svm_scores)
 
 
-            internal_user = db_core.User.get(db_core.User.id == internal_id)
-            self.logger.info("LR Speaker Model for {}. EER: {}, Thresh: {}".format(internal_user.username, float(lr_eer), float(lr_threshold)))
-            self.logger.info("SVM Speaker Model for {}. EER: {}, Thresh: {}".format(internal_user.username, float(svm_eer), float(svm_threshold)))
+            internal_user = users[internal_id]
+            self.logger.info("LR Speaker Model for %s. EER: %s, Thresh: %s", internal_user.username, float(lr_eer), float(lr_threshold))
+            self.logger.info("SVM Speaker Model for %s. EER: %s, Thresh: %s", internal_user.username, float(svm_eer), float(svm_threshold))
 
-            db_core.write_speaker_model(internal_user, lr_model, float(lr_threshold))
-            db_core.write_speaker_model_svm(internal_user, svm_model, float(svm_threshold))
+            db_core.write_speaker_model(internal_user, 'lr', lr_model, float(lr_threshold))
+            db_core.write_speaker_model(internal_user, 'svm', svm_model, float(svm_threshold))
+
+        self.registry.invalidate()
 
 
     def classify_speaker(self, embedding):
@@ -101,16 +151,14 @@ class SpeakerClassificationProcessor:
         :return: user_id if query has positive result or None for failed identification.
         """
 
-        users = [user for user in db_core.User.select()]
-
-        if self.mode == 'lr':
-            speaker_models, thresholds = zip(*[db_core.load_speaker_model(user, sklearn.linear_model.LogisticRegression(solver='liblinear', class_weight='balanced')) for user in users])
-        elif self.mode == 'svm':
-            speaker_models, thresholds = zip(*[db_core.load_speaker_model_svm(user) for user in users])
-        else:
+        if self.mode not in ('lr', 'svm'):
             raise ValueError("Invalid mode")
 
-        user_ids = [user.id for user in users]
+        speaker_models = self.registry.get()
+        if len(speaker_models) == 0:
+            return None
+
+        user_ids, speaker_models, thresholds = zip(*speaker_models)
 
         targets, decisions = self.get_target(user_ids, speaker_models, thresholds, embedding)
         labels, raw_decisions = zip(*decisions)
@@ -138,6 +186,8 @@ class SpeakerClassificationProcessor:
         :return: Logistic Regression model for target-speaker
         """
 
+        import sklearn.linear_model
+
         positiveLabels = np.ones(len(positives))
         negativeLabels = np.zeros(len(negatives))
         XLab = np.concatenate((positives, negatives), axis=0)
@@ -152,6 +202,8 @@ class SpeakerClassificationProcessor:
         :return: Logistic Regression model for target-speaker
         """
 
+        import sklearn.svm
+
         positiveLabels = np.ones(len(positives))
         negativeLabels = np.zeros(len(negatives))
         XLab = np.concatenate((positives, negatives), axis=0)
@@ -186,9 +238,10 @@ class SpeakerClassificationProcessor:
          """
         targets = []
         decisions = []
+        probs = []
         for label, model, threshold in zip(user_ids, speaker_models, thresholds):
             prob = model.predict_proba([embedding])[0][1]
-            self.logger.info("P({}) {}".format(db_core.User.get(db_core.User.id == label).username, prob))
+            probs.append((label, prob))
             if self.mode == 'lr':
                 threshold = self.fixed_thresh if self.fixed_thresh else threshold
                 if prob > threshold:
@@ -198,6 +251,7 @@ class SpeakerClassificationProcessor:
                 decisions.append((label, decision))
                 if self.fixed_thresh and prob > self.fixed_thresh:
                     targets.append((label, prob))
+        self.logger.info("Speaker probabilities %s", _ByUsername(probs, self.registry.usernames))
         return targets, decisions
 
 
@@ -222,8 +276,8 @@ class SpeakerClassificationProcessor:
             mu = (probs * mask).sum() / mask.sum()
             new_scores[i] = probs[i] / mu
 
-        self.logger.info("Probs: {}".format([(db_core.User.get(db_core.User.id == labels[idx]).username, probs[idx]) for idx in range(probs.shape[0])]))
-        self.logger.info("Scores: {}".format([(db_core.User.get(db_core.User.id == labels[idx]).username, new_scores[idx]) for idx in range(new_scores.shape[0])]))
+        self.logger.info("Probs: %s", _ByUsername(list(zip(labels, probs)), self.registry.usernames))
+        self.logger.info("Scores: %s", _ByUsername(list(zip(labels, new_scores)), self.registry.usernames))
 
 
         return labels[np.argmax(new_scores)]
@@ -259,7 +313,6 @@ if __name__ == '__main__':
     import os
 
 
-    gin.external_configurable(redis.Redis, module="redis")
     gin.external_configurable(sklearn.linear_model.LogisticRegression)
 
     gin.parse_config_file("processor/config/speaker_classification.gin")
@@ -273,5 +326,5 @@ if __name__ == '__main__':
 
     db = db_core.get_db_conn()
     db.connect()
-    db.create_tables([db_core.User, db_core.Embedding, db_core.Audio, db_core.SpeakerModel, db_core.SpeakerModelSVM])
+    db.create_tables([db_core.User, db_core.Embedding, db_core.Audio, db_core.SpeakerModelBlob])
     main()
\ No newline at end of file
@@ -1,17 +1,35 @@
+import json
 import torch
+import torch.nn.functional as F
 import numpy as np
 import inference
 import training.speaker_verification.model as models
-from torch.nn.utils.rnn import pad_sequence
+from training.speaker_verification.batching import pad_batch, length_buckets
 import gin
 
+# Metadata saved alongside an exported model by processor.export.save_scripted_model
+METADATA_FILE = "embedding.json"
+
 @gin.configurable
 class SpeakerEmbeddingProcessor:
 
-    def __init__(self, model_cls, checkpoint_path, use_gpu=False):
-        self.embedding_model = model_cls()
-        self.inference_engine = SpeakerEmbeddingInference(self.embedding_model, use_gpu=use_gpu)
-        self.inference_engine.load_params(checkpoint_path)
+    def __init__(self, model_cls, checkpoint_path, use_gpu=False, scripted_path=None, mmap_weights=False):
+        """
+        :param mmap_weights: map the checkpoint into memory instead of reading it, so that
+            processes loading the same file share its pages. The checkpoint must be in the
+            zipfile format (see processor.export --checkpoint-output).
+        """
+        if scripted_path:
+            self.embedding_model = None
+            self.inference_engine = ScriptedSpeakerEmbeddingInference(scripted_path, use_gpu=use_gpu)
+        else:
+            self.embedding_model = model_cls()
+            self.inference_engine = SpeakerEmbeddingInference(self.embedding_model, use_gpu=use_gpu)
+            self.inference_engine.load_params(checkpoint_path, mmap=mmap_weights)
+
+    def share_memory(self):
+        """ Move the model weights to shared memory so forked workers never copy them """
+        self.inference_engine.model.share_memory()
 
     def forward(self, spect_batch):
         return self.inference_engine.forward(spect_batch)
@@ -22,43 +40,150 @@ class SpeakerEmbeddingProcessor:
 @gin.configurable
 class SpeakerEmbeddingInference:
 
-    def __init__(self, model, use_gpu=False):
+    def __init__(self, model, use_gpu=False, bucket_size=None, max_pad_ratio=1.25,
+                 window_size=None, window_hop=None, window_aggregate='mean', max_windows_per_batch=64,
+                 attention_temperature=0.1, min_frames=None):
+        """
+        :param bucket_size: if set, batches are split into buckets of at most this many
+            utterances of similar length (see length_buckets) before inference
+        :param window_size: if set, utterances are split into overlapping windows of this
+            many frames, embedded at most max_windows_per_batch windows at a time, and the
+            window embeddings of each utterance are aggregated
+        :param window_hop: frames between window starts, defaults to half a window
+        :param window_aggregate: 'mean' or 'attention' (windows weighted by their cosine
+            similarity to the utterance mean, sharpened by attention_temperature)
+        :param min_frames: shortest utterance (and window) the model can embed, defaults
+            to the model's min_frames
+        """
         self.model = model.cuda() if use_gpu else model
+        self.model.eval()
         self.use_gpu = use_gpu
+        self.masked = True
+        self.min_frames = min_frames or getattr(model, 'min_frames', 1)
+        self.bucket_size = bucket_size
+        self.max_pad_ratio = max_pad_ratio
+        self.window_size = window_size
+        self.window_hop = window_hop or (max(1, window_size // 2) if window_size else None)
+        if window_size and self.window_hop < 1:
+            raise ValueError("window_hop must be at least one frame")
+        if window_size and window_size < self.min_frames:
+            raise ValueError("window_size must be at least the model's {} frames".format(self.min_frames))
+        self.window_aggregate = window_aggregate
+        self.max_windows_per_batch = max_windows_per_batch
+        self.attention_temperature = attention_temperature
 
     def forward(self, utterance_batch):
         """ Compute utterances
         :param utterance_batch: list of (T, F)
         :return: embedding matrix (N, D)
         """
-        self.model.eval()
         utterance_batch = [u for u in utterance_batch]
+        shortest = min(len(u) for u in utterance_batch)
+        if shortest < self.min_frames:
+            raise ValueError("Utterance of {} frames is shorter than the {} frames the model "
+                             "needs".format(shortest, self.min_frames))
+        if self.window_size:
+            return self._windowed_embed(utterance_batch)
+        if not self.bucket_size or len(utterance_batch) <= 1:
+            return self._embed(utterance_batch)
+
+        seq_lens = [len(u) for u in utterance_batch]
+        embeddings = None
+        for bucket in length_buckets(seq_lens, self.bucket_size, self.max_pad_ratio):
+            bucket_embeddings = self._embed([utterance_batch[i] for i in bucket])
+            if embeddings is None:
+                embeddings = bucket_embeddings.new_empty((len(utterance_batch), bucket_embeddings.size(1)))
+            embeddings[torch.LongTensor(bucket)] = bucket_embeddings
+        return embeddings
+
+    def _split_windows(self, utterance):
+        """ Overlapping window views of a (T, F) utterance, the last one ending at T.
+        Every window is window_size frames long, so never shorter than min_frames. """
+        length = len(utterance)
+        if length <= self.window_size:
+            return [utterance]
+        starts = list(range(0, length - self.window_size + 1, self.window_hop))
+        if starts[-1] + self.window_size < length:
+            starts.append(length - self.window_size)
+        return [utterance[s:s + self.window_size] for s in starts]
+
+    def _aggregate(self, window_embeddings):
+        if self.window_aggregate == 'mean':
+            return window_embeddings.mean(dim=0)
+        elif self.window_aggregate == 'attention':
+            centroid = window_embeddings.mean(dim=0, keepdim=True)
+            scores = F.cosine_similarity(window_embeddings, centroid) / self.attention_temperature
+            weights = F.softmax(scores, dim=0)
+            return (weights.unsqueeze(1) * window_embeddings).sum(dim=0)
+        else:
+            raise ValueError("Invalid window aggregation specified")
+
+    def _windowed_embed(self, utterance_batch):
+        windows = []
+        owners = []
+        for i, utterance in enumerate(utterance_batch):
+            utterance_windows = self._split_windows(utterance)
+            windows.extend(utterance_windows)
+            owners.extend([i] * len(utterance_windows))
+
+        window_embeddings = torch.cat([self._embed(windows[start:start + self.max_windows_per_batch])
+                                       for start in range(0, len(windows), self.max_windows_per_batch)])
+
+        owners = torch.LongTensor(owners)
+        return torch.stack([self._aggregate(window_embeddings[owners == i]) for i in range(len(utterance_batch))])
+
+    def _embed(self, utterance_batch):
         seq_batch, seq_lens = process_data_batch(utterance_batch, mode="wrap")
         seq_batch = seq_batch.cuda() if self.use_gpu else seq_batch
         with torch.no_grad():
             embeddings = self.model([seq_batch, seq_lens], em=True)
         return embeddings.cpu()
 
-    def load_params(self, checkpoint_path):
-        cpd = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
-        self.model.load_state_dict(cpd["model"])
+    def load_params(self, checkpoint_path, mmap=False):
+        if mmap:
+            cpd = torch.load(checkpoint_path, map_location='cpu', mmap=True)
+            # assign swaps in the mapped CPU tensors, so move to the GPU afterwards
+            self.model.load_state_dict(cpd["model"], assign=True)
+            if self.use_gpu:
+                self.model.cuda()
+        else:
+            cpd = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+            self.model.load_state_dict(cpd["model"])
+        self.model.eval()
+
+
+class ScriptedSpeakerEmbeddingInference(SpeakerEmbeddingInference):
+    """ Serves a frozen TorchScript embedding model written by processor.export
+
+    A model saved as unmasked (the static int8 model) pools over padding too, so its
+    utterances are embedded one at a time and never padded.
+    """
+
+    def __init__(self, scripted_path, use_gpu=False, **kwargs):
+        extra_files = {METADATA_FILE: ""}
+        model = torch.jit.load(scripted_path, map_location='cuda' if use_gpu else 'cpu', _extra_files=extra_files)
+        metadata = json.loads(extra_files[METADATA_FILE] or "{}")
+        # The traced model does not check lengths itself
+        kwargs.setdefault('min_frames', metadata.get("min_frames"))
+        super(ScriptedSpeakerEmbeddingInference, self).__init__(model, use_gpu=use_gpu, **kwargs)
+        # Models exported before the metadata was written are all masked
+        self.masked = metadata.get("masked", True)
+        if not self.masked and self.bucket_size:
+            raise ValueError("Length bucketing pads batches, which an unmasked model cannot serve")
+
+    def _embed(self, utterance_batch):
+        if not self.masked and len(utterance_batch) > 1:
+            return torch.cat([self._embed([u]) for u in utterance_batch])
+        seq_batch, seq_lens = process_data_batch(utterance_batch, mode="wrap")
+        seq_batch = seq_batch.cuda() if self.use_gpu else seq_batch
+        seq_lens = torch.LongTensor(seq_lens)
+        seq_lens = seq_lens.cuda() if self.use_gpu else seq_lens
+        with torch.no_grad():
+            embeddings = self.model(seq_batch, seq_lens)
+        return embeddings.cpu()
 
 
 def process_data_batch(data_batch, mode='zeros'):
     # pad the sequences, each seq must be (L, *)
-    seq_lens = [len(x) for x in data_batch]
-    max_len = max(seq_lens)
-    pad_widths = [max_len - l for l in seq_lens]
-
-    if mode == 'zeros':
-        data_batch = sorted(data_batch, key=lambda s: s.shape[0], reverse=True)
-        seq_lens = sorted(seq_lens, reverse=True)
-        seq_batch = pad_sequence(data_batch, batch_first=True)
-    elif mode == 'wrap':
-        seq_batch = torch.stack(
-            [torch.FloatTensor(np.pad(x, pad_width=((0, w), (0, 0)), mode='wrap')) for w, x in
-             zip(pad_widths, data_batch)])
-    else:
-        raise ValueError("Invalid mode specified")
-
+    seq_batch, seq_lens = pad_batch(data_batch, mode=mode, sort=(mode == 'zeros'))
     return seq_batch.unsqueeze(1), seq_lens
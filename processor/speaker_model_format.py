@@ -0,0 +1,179 @@
+""" Compact, versioned binary format for per-speaker classification models.
+
+A serialized model is a fixed little-endian header followed by float64 arrays:
+
+    magic      4s   b'YSPK'
+    version    H    FORMAT_VERSION
+    kind       B    KIND_LR or KIND_SVM
+    kernel     B    KERNEL_LINEAR or KERNEL_RBF
+    n_features I    embedding dimensionality D
+    n_support  I    number of support vectors (0 for LR)
+    threshold  d    decision threshold selected at the EER
+    intercept  d
+    gamma      d    RBF kernel width (0 for LR)
+    prob_a     d    Platt scaling parameters (0 for LR)
+    prob_b     d
+
+    LR payload:  coef (D,)
+    SVM payload: dual_coef (n_support,), support_vectors (n_support, D)
+
+The header is 56 bytes, so the payload stays 8-byte aligned and the arrays can be
+viewed in place with np.frombuffer. Decoded models only depend on numpy and expose
+the predict / predict_proba / decision_function subset of the sklearn API that the
+classification processor uses.
+"""
+import struct
+import numpy as np
+
+MAGIC = b'YSPK'
+FORMAT_VERSION = 1
+
+KIND_LR = 0
+KIND_SVM = 1
+
+KERNEL_LINEAR = 0
+KERNEL_RBF = 1
+
+_HEADER = struct.Struct('<4sHBBIIddddd')
+_DTYPE = np.dtype('<f8')
+
+# libsvm clips pairwise probabilities to this range
+_MIN_PROB = 1e-7
+
+
+class LinearSpeakerModel:
+    """ Binary logistic regression speaker model """
+
+    def __init__(self, coef, intercept):
+        self.coef = coef
+        self.intercept = intercept
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        return X.dot(self.coef) + self.intercept
+
+    def predict_proba(self, X):
+        p = 1.0 / (1.0 + np.exp(-self.decision_function(X)))
+        return np.stack([1.0 - p, p], axis=1)
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.float64)
+
+
+class KernelSpeakerModel:
+    """ Binary RBF SVM speaker model with Platt-scaled probabilities """
+
+    def __init__(self, support_vectors, dual_coef, intercept, gamma, prob_a, prob_b):
+        self.support_vectors = support_vectors
+        self.dual_coef = dual_coef
+        self.intercept = intercept
+        self.gamma = gamma
+        self.prob_a = prob_a
+        self.prob_b = prob_b
+        # ||sv||^2 is reused by every query
+        self._sv_sq_norms = np.einsum('ij,ij->i', support_vectors, support_vectors)
+
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        sq_dists = (np.einsum('ij,ij->i', X, X)[:, None]
+                    - 2.0 * X.dot(self.support_vectors.T)
+                    + self._sv_sq_norms[None, :])
+        kernel = np.exp(-self.gamma * np.maximum(sq_dists, 0.0))
+        return kernel.dot(self.dual_coef) + self.intercept
+
+    def predict_proba(self, X):
+        # libsvm applies the sigmoid to the decision value of the first class, which
+        # is the negated sklearn (positive class) decision value.
+        f_ApB = -self.decision_function(X) * self.prob_a + self.prob_b
+        # Written as libsvm's sigmoid_predict to avoid overflow either way
+        e = np.exp(-np.abs(f_ApB))
+        r01 = np.where(f_ApB >= 0, e / (1.0 + e), 1.0 / (1.0 + e))
+        r01 = np.minimum(np.maximum(r01, _MIN_PROB), 1.0 - _MIN_PROB)
+        return _pairwise_probability(r01, 1.0 - r01)
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.float64)
+
+
+def _pairwise_probability(r01, r10, max_iter=100, eps=0.0025):
+    """ libsvm's multiclass_probability for two classes, vectorized over samples
+
+    The iteration stops at libsvm's tolerance rather than at the exact solution
+    (r01, r10), so it is reproduced step by step for the probabilities, and so the
+    thresholds selected on them, to match sklearn's.
+
+    :return: (N, 2) class probabilities
+    """
+    q = np.stack([np.stack([r10 * r10, -r10 * r01], axis=1),
+                  np.stack([-r10 * r01, r01 * r01], axis=1)], axis=1)
+    p = np.full((len(r01), 2), 0.5)
+    active = np.ones(len(r01), dtype=bool)
+    for _ in range(max_iter):
+        qp = np.einsum('ntj,nj->nt', q, p)
+        pqp = np.einsum('nt,nt->n', p, qp)
+        active &= np.abs(qp - pqp[:, None]).max(axis=1) >= eps
+        if not active.any():
+            break
+        for t in range(2):
+            diff = np.where(active, (-qp[:, t] + pqp) / q[:, t, t], 0.0)
+            p[:, t] += diff
+            pqp = (pqp + diff * (diff * q[:, t, t] + 2 * qp[:, t])) / (1 + diff) / (1 + diff)
+            qp = (qp + diff[:, None] * q[:, t, :]) / (1 + diff)[:, None]
+            p /= (1 + diff)[:, None]
+    return p
+
+
+def serialize_speaker_model(model, threshold):
+    """ Serialize a fitted sklearn LogisticRegression or SVC speaker model
+
+    :param model: fitted binary sklearn.linear_model.LogisticRegression or sklearn.svm.SVC
+    :param threshold: decision threshold for the speaker
+    :return: bytes in the compact speaker model format
+    """
+    if hasattr(model, 'support_vectors_'):
+        if model.kernel != 'rbf':
+            raise ValueError("Only rbf SVM speaker models are supported")
+        support_vectors = np.ascontiguousarray(model.support_vectors_, dtype=_DTYPE)
+        dual_coef = np.ascontiguousarray(model.dual_coef_.reshape(-1), dtype=_DTYPE)
+        n_support, n_features = support_vectors.shape
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, KIND_SVM, KERNEL_RBF, n_features, n_support,
+                              float(threshold), float(model.intercept_[0]), float(model._gamma),
+                              float(model.probA_[0]), float(model.probB_[0]))
+        return header + dual_coef.tobytes() + support_vectors.tobytes()
+    elif hasattr(model, 'coef_'):
+        coef = np.ascontiguousarray(model.coef_.reshape(-1), dtype=_DTYPE)
+        header = _HEADER.pack(MAGIC, FORMAT_VERSION, KIND_LR, KERNEL_LINEAR, coef.shape[0], 0,
+                              float(threshold), float(model.intercept_[0]), 0.0, 0.0, 0.0)
+        return header + coef.tobytes()
+    else:
+        raise ValueError("Unsupported speaker model type {}".format(type(model).__name__))
+
+
+def deserialize_speaker_model(data):
+    """ Decode a compact speaker model without copying its arrays
+
+    :param data: bytes-like object produced by serialize_speaker_model
+    :return: (model, threshold)
+    """
+    magic, version, kind, kernel, n_features, n_support, threshold, intercept, gamma, prob_a, prob_b = \
+        _HEADER.unpack_from(data)
+
+    if magic != MAGIC:
+        raise ValueError("Not a compact speaker model")
+    if version != FORMAT_VERSION:
+        raise ValueError("Unsupported speaker model format version {}".format(version))
+
+    offset = _HEADER.size
+    if kind == KIND_LR:
+        coef = np.frombuffer(data, dtype=_DTYPE, count=n_features, offset=offset)
+        model = LinearSpeakerModel(coef, intercept)
+    elif kind == KIND_SVM and kernel == KERNEL_RBF:
+        dual_coef = np.frombuffer(data, dtype=_DTYPE, count=n_support, offset=offset)
+        offset += n_support * _DTYPE.itemsize
+        support_vectors = np.frombuffer(data, dtype=_DTYPE, count=n_support * n_features,
+                                        offset=offset).reshape(n_support, n_features)
+        model = KernelSpeakerModel(support_vectors, dual_coef, intercept, gamma, prob_a, prob_b)
+    else:
+        raise ValueError("Unsupported speaker model kind {} (kernel {})".format(kind, kernel))
+
+    return model, threshold
@@ -0,0 +1,25 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """ Wall clock time of each named stage of processor initialization """
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.stages)
+        parts = ["{} {:.2f}s".format(name, seconds) for name, seconds in self.stages]
+        return "Startup took {:.2f}s ({})".format(total, ", ".join(parts))
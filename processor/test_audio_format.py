@@ -0,0 +1,70 @@
+""" The web server encodes framed audio with its own copy of the format, since it is
+deployed without the processor package. These tests keep app/login/audio.py in
+agreement with processor.audio_format and data/processing/resample.py.
+
+    python -m pytest processor/test_audio_format.py
+"""
+import importlib.util
+import os
+from io import BytesIO
+import pytest
+
+np = pytest.importorskip("numpy")
+wavfile = pytest.importorskip("scipy.io.wavfile")
+
+from processor import audio_format
+
+APP_AUDIO = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "login", "audio.py")
+
+
+@pytest.fixture(scope="module")
+def app_audio():
+    spec = importlib.util.spec_from_file_location("app_login_audio", APP_AUDIO)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def wav_bytes(data, sample_rate):
+    buf = BytesIO()
+    wavfile.write(buf, sample_rate, data)
+    return buf.getvalue()
+
+
+def test_header_matches(app_audio):
+    assert app_audio.MAGIC == audio_format.MAGIC
+    assert app_audio.FORMAT_VERSION == audio_format.FORMAT_VERSION
+    assert app_audio.HEADER.format == audio_format.HEADER.format
+
+
+def test_stream_header_reads_to_end_of_buffer(app_audio):
+    header = app_audio.stream_header(audio_format.CANONICAL_SAMPLE_RATE)
+    assert audio_format.read_header(header) == (audio_format.CANONICAL_SAMPLE_RATE, 0)
+
+
+def test_normalized_upload_decodes(app_audio):
+    samples = (np.random.RandomState(0).randn(1600) * 3000).astype(np.int16)
+    framed = app_audio.normalize_upload(wav_bytes(samples, 16000), 16000)
+    decoded, sample_rate = audio_format.decode(framed)
+    assert sample_rate == 16000
+    np.testing.assert_array_equal(decoded, samples)
+
+
+def test_streamed_upload_decodes(app_audio):
+    samples = (np.random.RandomState(1).randn(2, 1000) * 3000).astype(np.int16).T
+    upload = wav_bytes(samples, 44100)
+    normalizer = app_audio.StreamingWavNormalizer()
+    framed = b''.join(normalizer.feed(upload[i:i + 37]) for i in range(0, len(upload), 37))
+    normalizer.close()
+    decoded, sample_rate = audio_format.decode(framed)
+    assert sample_rate == 44100
+    np.testing.assert_array_equal(decoded, samples[:, 0])
+
+
+@pytest.mark.parametrize("source_rate", [8000, 22050, 44100, 48000])
+def test_resampling_filter_matches(app_audio, source_rate):
+    from data.processing.resample import polyphase_filter
+    up, down, taps = app_audio._polyphase_filter(source_rate, audio_format.CANONICAL_SAMPLE_RATE)
+    expected_up, expected_down, expected_taps = polyphase_filter(source_rate, audio_format.CANONICAL_SAMPLE_RATE)
+    assert (up, down) == (expected_up, expected_down)
+    np.testing.assert_array_equal(taps, expected_taps)
@@ -0,0 +1,77 @@
+""" Padding and length bucketing of utterance batches for embedding inference.
+
+    python -m pytest processor/test_batching.py
+"""
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+
+from training.speaker_verification.batching import pad_batch, length_buckets
+
+NUM_FEATS = 3
+
+
+def utterances(lengths):
+    rng = np.random.RandomState(0)
+    return [rng.randn(l, NUM_FEATS).astype(np.float32) for l in lengths]
+
+
+def test_zero_padding():
+    batch = utterances([5, 2, 4])
+    padded, seq_lens = pad_batch(batch, mode='zeros')
+    assert padded.shape == (3, 5, NUM_FEATS)
+    assert seq_lens == [5, 2, 4]
+    for x, u in zip(padded, batch):
+        np.testing.assert_array_equal(x[:len(u)].numpy(), u)
+        assert not x[len(u):].any()
+
+
+def test_zero_padding_sorted():
+    batch = utterances([2, 5, 4])
+    padded, seq_lens = pad_batch(batch, mode='zeros', sort=True)
+    assert seq_lens == [5, 4, 2]
+    np.testing.assert_array_equal(padded[0].numpy(), batch[1])
+
+
+def test_wrap_padding():
+    batch = utterances([5, 2, 3])
+    padded, seq_lens = pad_batch(batch, mode='wrap')
+    assert seq_lens == [5, 2, 3]
+    for x, u in zip(padded, batch):
+        np.testing.assert_array_equal(x.numpy(), u[np.arange(5) % len(u)])
+
+
+def test_wrap_rejects_empty_utterance():
+    with pytest.raises(ValueError, match="index 1"):
+        pad_batch(utterances([4, 0, 2]), mode='wrap')
+
+
+def test_zero_padding_allows_empty_utterance():
+    padded, seq_lens = pad_batch(utterances([4, 0]), mode='zeros')
+    assert seq_lens == [4, 0]
+    assert not padded[1].any()
+
+
+def test_rejects_empty_batch():
+    with pytest.raises(ValueError):
+        pad_batch([], mode='wrap')
+
+
+def test_rejects_unknown_mode():
+    with pytest.raises(ValueError):
+        pad_batch(utterances([2]), mode='reflect')
+
+
+def test_length_buckets_bound_padding():
+    seq_lens = [100, 400, 110, 125, 390, 300, 126, 99]
+    buckets = length_buckets(seq_lens, max_batch_size=64, max_pad_ratio=1.25)
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(seq_lens)))
+    for bucket in buckets:
+        lens = [seq_lens[i] for i in bucket]
+        assert max(lens) <= 1.25 * min(lens)
+
+
+def test_length_buckets_bound_size():
+    buckets = length_buckets([100] * 10, max_batch_size=4)
+    assert [len(bucket) for bucket in buckets] == [4, 4, 2]
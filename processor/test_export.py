@@ -0,0 +1,67 @@
+""" Parity of the TorchScript embedding model written by processor.export with the eager
+model it was traced from.
+
+    python -m pytest processor/test_export.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+nn = torch.nn
+
+from training.speaker_verification.model import IdentifyAndEmbed
+from processor.export import export_scripted_model
+
+NUM_FEATS = 64
+TOL = 1e-4
+
+
+@pytest.fixture(scope="module")
+def models():
+    """ A randomly initialised model with non-trivial BatchNorm statistics, so that
+    folding them into the convolutions is exercised, and its export """
+    torch.manual_seed(0)
+    model = IdentifyAndEmbed(nspeakers=10)
+    for module in model.modules():
+        if isinstance(module, nn.BatchNorm2d):
+            module.running_mean.uniform_(-0.5, 0.5)
+            module.running_var.uniform_(0.5, 2.0)
+            nn.init.uniform_(module.weight, 0.5, 1.5)
+            nn.init.uniform_(module.bias, -0.5, 0.5)
+    model.eval()
+    return model, export_scripted_model(model)
+
+
+def relative_error(expected, actual):
+    return ((expected - actual).norm() / expected.norm()).item()
+
+
+@pytest.mark.parametrize("length", [100, 150, 301, 500, 777])
+def test_single_utterance(models, length):
+    model, scripted = models
+    x = torch.randn(1, 1, length, NUM_FEATS)
+    seq_lens = torch.LongTensor([length])
+    with torch.no_grad():
+        assert relative_error(model([x, seq_lens], em=True), scripted(x, seq_lens)) < TOL
+
+
+def test_padded_batch(models):
+    model, scripted = models
+    seq_lens = torch.LongTensor([600, 421, 300, 120])
+    x = torch.randn(len(seq_lens), 1, int(seq_lens.max()), NUM_FEATS)
+    for i, l in enumerate(seq_lens):
+        x[i, :, l:] = 0
+    with torch.no_grad():
+        assert relative_error(model([x, seq_lens], em=True), scripted(x, seq_lens)) < TOL
+
+
+def test_padding_does_not_change_embeddings(models):
+    """ An utterance embeds the same alone and padded into a batch with a longer one """
+    _, scripted = models
+    short = torch.randn(1, 1, 250, NUM_FEATS)
+    batch = torch.zeros(2, 1, 700, NUM_FEATS)
+    batch[0] = torch.randn(1, 700, NUM_FEATS)
+    batch[1, :, :250] = short[0]
+    with torch.no_grad():
+        alone = scripted(short, torch.LongTensor([250]))
+        padded = scripted(batch, torch.LongTensor([700, 250]))[1:]
+    assert relative_error(alone, padded) < TOL
@@ -0,0 +1,87 @@
+""" Masked forward of the speaker embedding model served by the processor.
+
+    python -m pytest processor/test_model.py
+"""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from training.speaker_verification.model import IdentifyAndEmbed
+
+NUM_FEATS = 64
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    return IdentifyAndEmbed(nspeakers=10).eval()
+
+
+def embed(model, lengths, max_len=None):
+    """ Embed random utterances of lengths, zero padded to max_len """
+    lengths = torch.LongTensor(lengths)
+    x = torch.randn(len(lengths), 1, max_len or int(lengths.max()), NUM_FEATS)
+    for i, l in enumerate(lengths):
+        x[i, :, l:] = 0
+    with torch.no_grad():
+        return model([x, lengths], em=True)
+
+
+def relative_error(expected, actual):
+    return ((expected - actual).norm() / expected.norm()).item()
+
+
+def test_masked_batch_matches_single_utterances(model):
+    """ Padding an utterance into a batch with longer ones leaves its embedding unchanged """
+    lengths = [600, 421, 300, 120, model.min_frames]
+    x = torch.zeros(len(lengths), 1, max(lengths), NUM_FEATS)
+    for i, l in enumerate(lengths):
+        x[i, :, :l] = torch.randn(1, l, NUM_FEATS)
+    with torch.no_grad():
+        batch = model([x, torch.LongTensor(lengths)], em=True)
+        for i, l in enumerate(lengths):
+            alone = model([x[i:i + 1, :, :l], torch.LongTensor([l])], em=True)
+            assert relative_error(alone, batch[i:i + 1]) < 1e-4
+
+
+def test_unpadded_masked_matches_unmasked(model):
+    x = torch.randn(2, 1, 257, NUM_FEATS)
+    with torch.no_grad():
+        masked = model([x, torch.LongTensor([257, 257])], em=True)
+        unmasked = model([x, None], em=True)
+    assert relative_error(unmasked, masked) < 1e-4
+
+
+def test_min_frames_embeds(model):
+    assert embed(model, [model.min_frames]).shape == (1, model.embedding_size)
+
+
+def test_short_utterance_rejected(model):
+    with pytest.raises(ValueError):
+        embed(model, [5])
+
+
+def test_short_utterance_in_padded_batch_rejected(model):
+    with pytest.raises(ValueError):
+        embed(model, [300, model.min_frames - 1])
+
+
+@pytest.mark.parametrize("length", [13, 40, 301])
+def test_windows_never_below_min_frames(model, length):
+    from processor.speaker_embedding_processor import SpeakerEmbeddingInference
+    inference = SpeakerEmbeddingInference(model, window_size=model.min_frames, max_windows_per_batch=4)
+    utterance = torch.randn(length, NUM_FEATS).numpy()
+    assert inference.forward([utterance]).shape == (1, model.embedding_size)
+
+
+def test_window_inference_rejects_short_utterance(model):
+    from processor.speaker_embedding_processor import SpeakerEmbeddingInference
+    inference = SpeakerEmbeddingInference(model, window_size=100)
+    with pytest.raises(ValueError):
+        inference.forward([torch.randn(300, NUM_FEATS).numpy(), torch.randn(5, NUM_FEATS).numpy()])
+
+
+def test_window_smaller_than_min_frames_rejected(model):
+    from processor.speaker_embedding_processor import SpeakerEmbeddingInference
+    with pytest.raises(ValueError):
+        SpeakerEmbeddingInference(model, window_size=model.min_frames - 1)
@@ -0,0 +1,214 @@
+""" Request lanes shared by the web server (app/login/queues.py) and the processor
+(processor.queues), against an in-process fake redis.
+
+    python -m pytest processor/test_queues.py
+"""
+import importlib.util
+import json
+import os
+import time
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from processor import queues
+from processor.queues import RequestQueue, LANES, USERNAMES_KEY, TIMEOUT_RESULT, expired
+
+APP_QUEUES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app", "login", "queues.py")
+
+MAX_DEPTH = {'authenticate': 2, 'register': 1, 'stream': 1}
+
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture(scope="module")
+def web_queues():
+    """ The web server's side of the lanes, configured with small depths """
+    pytest.importorskip("django")
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure(YOLO_MAX_QUEUE_DEPTH=MAX_DEPTH,
+                           YOLO_REQUEST_DEADLINE={'authenticate': 10, 'register': 300},
+                           YOLO_AUDIO_TTL=600, YOLO_STREAM_MAX_SECONDS=30, YOLO_STREAM_MAX_BYTES=64)
+    spec = importlib.util.spec_from_file_location("app_login_queues", APP_QUEUES)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def push(conn, request_type, request_id, **fields):
+    request = dict(id=request_id, type=request_type, **fields)
+    conn.rpush(LANES[request_type], json.dumps(request))
+    return request
+
+
+def test_lanes_match(web_queues):
+    assert web_queues.LANES == LANES
+    assert web_queues.STREAM_LANE == queues.STREAM_LANE
+    assert web_queues.USERNAMES == USERNAMES_KEY
+    assert web_queues.STREAM_ABORT == queues.STREAM_ABORT
+
+
+@pytest.mark.parametrize("reliable", [False, True])
+def test_authentications_before_registrations(conn, reliable):
+    request_queue = RequestQueue(conn, block_timeout=1, reliable=reliable)
+    request_queue.start("worker")
+    push(conn, "register", "r1", name="alice")
+    push(conn, "authenticate", "a1")
+    push(conn, "register", "r2", name="bob")
+    push(conn, "authenticate", "a2")
+    assert [request_queue.pop()["id"] for _ in range(4)] == ["a1", "a2", "r1", "r2"]
+
+
+def test_expired():
+    now = time.time()
+    assert not expired({"id": "a"})
+    assert not expired({"id": "a", "deadline": now + 5}, now)
+    assert expired({"id": "a", "deadline": now - 5}, now)
+
+
+def test_reject_expired_answers_timeout(conn):
+    request_queue = RequestQueue(conn)
+    conn.set("audio:a1", b"audio")
+    request_queue.reject_expired({"id": "a1", "type": "authenticate"})
+    assert json.loads(conn.get("result:a1")) == TIMEOUT_RESULT
+    assert not conn.exists("audio:a1")
+
+
+def test_failed_registration_releases_name(conn):
+    conn.sadd(USERNAMES_KEY, "alice", "bob")
+    request_queue = RequestQueue(conn, is_registered=lambda name: name == "bob")
+    request_queue.fail({"id": "r1", "type": "register", "name": "alice"})
+    request_queue.fail({"id": "r2", "type": "register", "name": "bob"})
+    assert conn.smembers(USERNAMES_KEY) == {b"bob"}
+
+
+def test_enqueue_stores_audio_and_stamps_deadline(conn, web_queues):
+    request = {"id": "a1", "type": "authenticate"}
+    assert web_queues.enqueue(conn, request, b"audio") == web_queues.QUEUED
+    assert conn.get("audio:a1") == b"audio"
+    assert 0 < conn.ttl("audio:a1") <= 600
+    queued = json.loads(conn.lpop(LANES["authenticate"]))
+    assert queued["id"] == "a1"
+    assert queued["deadline"] == pytest.approx(time.time() + 10, abs=2)
+
+
+def test_enqueue_rejects_full_lane(conn, web_queues):
+    for i in range(MAX_DEPTH["authenticate"]):
+        assert web_queues.enqueue(conn, {"id": "a{}".format(i), "type": "authenticate"}, b"audio") == web_queues.QUEUED
+    assert web_queues.enqueue(conn, {"id": "full", "type": "authenticate"}, b"audio") == web_queues.FULL
+    assert not conn.exists("audio:full")
+    # Lanes are admitted independently
+    assert web_queues.enqueue(conn, {"id": "r1", "type": "register", "name": "alice"}, b"audio") == web_queues.QUEUED
+
+
+def test_enqueue_claims_username(conn, web_queues):
+    conn.sadd(USERNAMES_KEY, "alice")
+    request = {"id": "r1", "type": "register", "name": "alice"}
+    assert web_queues.enqueue(conn, request, b"audio") == web_queues.NAME_TAKEN
+    assert conn.llen(LANES["register"]) == 0
+    assert not conn.exists("audio:r1")
+
+    assert web_queues.enqueue(conn, {"id": "r2", "type": "register", "name": "bob"}, b"audio") == web_queues.QUEUED
+    assert conn.sismember(USERNAMES_KEY, "bob")
+
+
+def test_full_lane_leaves_username_unclaimed(conn, web_queues):
+    push(conn, "register", "r0", name="carol")
+    request = {"id": "r1", "type": "register", "name": "alice"}
+    assert web_queues.enqueue(conn, request, b"audio") == web_queues.FULL
+    assert not conn.sismember(USERNAMES_KEY, "alice")
+
+
+def reaper(conn, **kwargs):
+    """ A reliable queue that reaps without starting its heartbeat and reaper threads """
+    request_queue = RequestQueue(conn, reliable=True, **kwargs)
+    request_queue.worker_id = "reaper"
+    return request_queue
+
+
+def in_flight(conn, worker_id, request, started=None, alive=True):
+    raw = json.dumps(request)
+    conn.sadd(queues.WORKERS_KEY, worker_id)
+    conn.rpush("processing:{}".format(worker_id), raw)
+    conn.hset("inflight:{}".format(worker_id), raw, started or time.time())
+    if alive:
+        conn.set("heartbeat:{}".format(worker_id), time.time())
+    conn.set("audio:{}".format(request["id"]), b"audio")
+    return raw
+
+
+def test_reliable_pop_tracks_until_ack(conn):
+    request_queue = RequestQueue(conn, reliable=True)
+    request_queue.start("worker")
+    push(conn, "authenticate", "a1")
+    conn.set("audio:a1", b"audio")
+
+    request = request_queue.pop()
+    assert conn.llen("processing:worker") == 1
+    assert conn.hlen("inflight:worker") == 1
+
+    request_queue.ack(request)
+    assert conn.llen("processing:worker") == 0
+    assert conn.hlen("inflight:worker") == 0
+    assert not conn.exists("audio:a1")
+
+
+def test_reap_requeues_dead_worker(conn):
+    in_flight(conn, "dead", {"id": "a1", "type": "authenticate"}, alive=False)
+    push(conn, "authenticate", "a2")
+    reaper(conn).reap()
+
+    requeued = json.loads(conn.lindex(LANES["authenticate"], 0))
+    assert requeued["id"] == "a1"
+    assert requeued["attempts"] == 1
+    assert conn.exists("audio:a1")
+    assert not conn.exists("processing:dead", "inflight:dead")
+    assert not conn.sismember(queues.WORKERS_KEY, "dead")
+
+
+def test_reap_leaves_live_worker_within_visibility_timeout(conn):
+    in_flight(conn, "live", {"id": "a1", "type": "authenticate"})
+    reaper(conn, visibility_timeout=600).reap()
+    assert conn.llen("processing:live") == 1
+    assert conn.llen(LANES["authenticate"]) == 0
+
+
+def test_reap_requeues_request_stuck_past_visibility_timeout(conn):
+    in_flight(conn, "live", {"id": "r1", "type": "register", "name": "alice"}, started=time.time() - 700)
+    reaper(conn, visibility_timeout=600).reap()
+    assert conn.llen("processing:live") == 0
+    assert json.loads(conn.lindex(LANES["register"], 0))["id"] == "r1"
+    assert conn.sismember(queues.WORKERS_KEY, "live")
+
+
+def test_reap_gives_up_after_max_attempts(conn):
+    conn.sadd(USERNAMES_KEY, "alice")
+    in_flight(conn, "dead", {"id": "r1", "type": "register", "name": "alice", "attempts": 2}, alive=False)
+    reaper(conn, max_attempts=3).reap()
+
+    assert conn.llen(LANES["register"]) == 0
+    assert json.loads(conn.get("result:r1")) == queues.FAILED_RESULT
+    assert not conn.exists("audio:r1")
+    assert not conn.sismember(USERNAMES_KEY, "alice")
+
+
+def test_reap_fails_streamed_request(conn):
+    in_flight(conn, "dead", {"id": "s1", "type": "authenticate", "stream": True}, alive=False)
+    conn.rpush("stream:s1", b"header")
+    reaper(conn).reap()
+
+    assert conn.llen(LANES["authenticate"]) == 0
+    assert json.loads(conn.get("result:s1")) == queues.FAILED_RESULT
+    assert not conn.exists("stream:s1")
+
+
+def test_one_reaper_at_a_time(conn):
+    conn.set(queues.REAPER_LOCK_KEY, "other")
+    in_flight(conn, "dead", {"id": "a1", "type": "authenticate"}, alive=False)
+    reaper(conn).reap()
+    assert conn.llen("processing:dead") == 1
@@ -0,0 +1,69 @@
+""" Speaker models decoded from processor.speaker_model_format must score exactly as the
+sklearn models they were written from, since their thresholds were selected on sklearn's
+probabilities.
+
+    python -m pytest processor/test_speaker_model_format.py
+"""
+import warnings
+from contextlib import contextmanager
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("sklearn")
+
+from sklearn.linear_model import LogisticRegression
+from sklearn.svm import SVC
+from processor.speaker_model_format import serialize_speaker_model, deserialize_speaker_model
+
+TOL = 1e-12
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.RandomState(0)
+    X = np.concatenate([rng.randn(40, 16) + 0.5, rng.randn(200, 16)])
+    y = np.r_[np.ones(40), np.zeros(200)]
+    queries = np.concatenate([X, rng.randn(500, 16) * 1.5])
+    return X, y, queries
+
+
+@pytest.fixture(params=["lr", "svm"])
+def model(request, data):
+    X, y, _ = data
+    if request.param == "lr":
+        return LogisticRegression().fit(X, y)
+    with _ignore_warnings():
+        return SVC(kernel='rbf', probability=True, gamma='scale', random_state=0).fit(X, y)
+
+
+@contextmanager
+def _ignore_warnings():
+    """ Newer sklearn deprecates SVC probabilities, which the speaker models still use """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        yield
+
+
+def round_trip(model, threshold=0.37):
+    with _ignore_warnings():
+        return deserialize_speaker_model(serialize_speaker_model(model, threshold))
+
+
+def test_threshold_round_trips(model):
+    _, threshold = round_trip(model)
+    assert threshold == 0.37
+
+
+def test_scores_match(model, data):
+    _, _, queries = data
+    decoded, _ = round_trip(model)
+    np.testing.assert_allclose(decoded.decision_function(queries), model.decision_function(queries), rtol=0, atol=TOL)
+    np.testing.assert_array_equal(decoded.predict(queries), model.predict(queries))
+
+
+def test_probabilities_match(model, data):
+    _, _, queries = data
+    decoded, _ = round_trip(model)
+    with _ignore_warnings():
+        expected = model.predict_proba(queries)
+    np.testing.assert_allclose(decoded.predict_proba(queries), expected, rtol=0, atol=TOL)
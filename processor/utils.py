@@ -1,10 +1,11 @@
-import pyaudio
 import wave
 
 import io
 
 
 def play_audio(blob):
+    import pyaudio
+
     #define stream chunk
     chunk = 1024
 
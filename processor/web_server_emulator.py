@@ -1,13 +1,25 @@
+""" Open-loop load generator for the processor.
+
+Requests arrive as a Poisson process at --rate per second regardless of how fast the
+processor answers, the way browsers hit the web server. Latency is measured from the
+moment a request is enqueued until its result:{id} key appears.
+
+    python -m processor.web_server_emulator --rate 5 --duration 60 --register-fraction 0.05
+"""
+import argparse
 import gin
-import redis
 import json
 import time
 import os
-import time
-import sys
+import threading
 import hashlib
 from datetime import datetime
-import random
+from io import BytesIO
+import numpy as np
+from scipy.io import wavfile
+from processor.queues import lane
+from processor import audio_format
+from processor.connections import get_redis_conn
 
 def hash_blob(blob):
     md5 = hashlib.md5()
@@ -27,39 +39,216 @@ def myconverter(o):
 def get_unique_id(audio_data):
     return hash_blob(audio_data)
 
-def build_fixtures():
-    audio_fixtures_path = "processor/audio_fixtures"
-    audio_paths = [os.path.join(audio_fixtures_path, file_name) for file_name in os.listdir(audio_fixtures_path)]
-    requests = []
-    audio_data = []
-    for audio_path in audio_paths:
-        f = open(audio_path, 'rb')
-        audio = f.read()
+
+def synthesize(seconds, sample_rate=16000, rng=np.random):
+    """ Voiced-speech-like test signal: a harmonic series on a wandering pitch with
+    syllable-rate amplitude modulation and background noise
+
+    :return: int16 samples
+    """
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    f0 = rng.uniform(90, 250) * (1 + 0.05 * np.sin(2 * np.pi * rng.uniform(0.5, 2) * t))
+    phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+    signal = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * rng.uniform(2, 5) * t))
+    signal = envelope * signal + 0.05 * rng.randn(len(t))
+    return (0.5 * 32767 * signal / np.max(np.abs(signal))).astype(np.int16)
+
+
+def synthesize_wav(seconds, sample_rate=16000, rng=np.random):
+    """ :return: 16-bit mono wav file bytes of a synthesize() signal """
+    with BytesIO() as b:
+        wavfile.write(b, sample_rate, synthesize(seconds, sample_rate, rng))
+        return b.getvalue()
+
+
+def build_fixtures(audio_fixtures_path="processor/audio_fixtures", n_synthetic=8, seconds=(3.0, 6.0)):
+    """ :return: list of audio:{id} payloads, wav files read from audio_fixtures_path if it
+    exists, else synthesized audio framed the way the web server sends it """
+    if os.path.isdir(audio_fixtures_path):
+        audio_data = []
+        for file_name in sorted(os.listdir(audio_fixtures_path)):
+            with open(os.path.join(audio_fixtures_path, file_name), 'rb') as f:
+                audio_data.append(f.read())
+        return audio_data
+
+    rng = np.random.RandomState(0)
+    return [audio_format.encode(synthesize(rng.uniform(*seconds), audio_format.CANONICAL_SAMPLE_RATE, rng),
+                                audio_format.CANONICAL_SAMPLE_RATE) for _ in range(n_synthetic)]
+
+
+class LoadGenerator:
+
+    def __init__(self, conn, fixtures, rate, duration, register_fraction=0.05, timeout=60.0, poll_interval=0.005,
+                 deadline=None, seed=0):
+        self.conn = conn
+        self.fixtures = fixtures
+        self.rate = rate
+        self.duration = duration
+        self.register_fraction = register_fraction
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.rng = np.random.RandomState(seed)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.latencies = {"register": [], "authenticate": []}
+        self.timed_out = {"register": 0, "authenticate": 0}
+        self.expired = {"register": 0, "authenticate": 0}
+        # Counts of every other error result by error, kept out of the latencies
+        self.failed = {"register": {}, "authenticate": {}}
+        self.sent = 0
+        self.done = False
+
+    def _build_request(self, n):
+        audio = self.fixtures[self.rng.randint(len(self.fixtures))]
         request = {
             "id": get_unique_id(audio),
             "timestamp": datetime.now()
         }
-        requests.append(request)
-        audio_data.append(audio)
-        f.close()
+        if self.rng.rand() < self.register_fraction:
+            request["type"] = "register"
+            request["name"] = "loadtest-{}-{}".format(os.getpid(), n)
+        else:
+            request["type"] = "authenticate"
+            request["prompt"] = "my voice is my password"
+        return request, audio
+
+    def _send_loop(self):
+        start = time.monotonic()
+        next_arrival = start
+        n = 0
+        while next_arrival - start < self.duration:
+            request, audio = self._build_request(n)
+            delay = next_arrival - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            enqueued = time.monotonic()
+            if self.deadline:
+                request["deadline"] = time.time() + self.deadline
+            pipe = self.conn.pipeline()
+            pipe.set('audio:{}'.format(request['id']), audio)
+            pipe.rpush(lane(request['type']), json.dumps(request, default=myconverter))
+            pipe.execute()
+            with self.lock:
+                self.pending[request['id']] = (request['type'], enqueued)
+                self.sent += 1
+
+            n += 1
+            # Arrivals are scheduled independently of completions, so a slow processor
+            # builds a queue instead of slowing the generator down
+            next_arrival += self.rng.exponential(1.0 / self.rate)
+        self.done = True
+
+    def _collect_loop(self):
+        while True:
+            with self.lock:
+                pending = list(self.pending.items())
+            if self.done and not pending:
+                return
 
-    return zip(requests, audio_data)
+            if pending:
+                pipe = self.conn.pipeline()
+                for request_id, _ in pending:
+                    pipe.get('result:{}'.format(request_id))
+                results = pipe.execute()
+                now = time.monotonic()
 
+                finished = []
+                for (request_id, (request_type, enqueued)), result in zip(pending, results):
+                    if result is not None:
+                        error = json.loads(result.decode('utf-8')).get("error")
+                        if error == "timeout":
+                            self.expired[request_type] += 1
+                        elif error:
+                            failed = self.failed[request_type]
+                            failed[error] = failed.get(error, 0) + 1
+                        else:
+                            self.latencies[request_type].append(now - enqueued)
+                        finished.append(request_id)
+                    elif now - enqueued > self.timeout:
+                        self.timed_out[request_type] += 1
+                        finished.append(request_id)
+
+                if finished:
+                    pipe = self.conn.pipeline()
+                    for request_id in finished:
+                        pipe.delete('result:{}'.format(request_id))
+                    pipe.execute()
+                    with self.lock:
+                        for request_id in finished:
+                            del self.pending[request_id]
+
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        """ :return: report dict """
+        collector = threading.Thread(target=self._collect_loop)
+        collector.start()
+        start = time.monotonic()
+        self._send_loop()
+        collector.join()
+        elapsed = time.monotonic() - start
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        def summarize(latencies):
+            if not latencies:
+                return {"count": 0}
+            latencies = np.asarray(latencies)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            return {"count": len(latencies), "mean": float(latencies.mean()), "p50": float(p50), "p95": float(p95),
+                    "p99": float(p99), "max": float(latencies.max())}
+
+        all_latencies = self.latencies["register"] + self.latencies["authenticate"]
+        report = {
+            "offered_rate": self.rate,
+            "duration": self.duration,
+            "sent": self.sent,
+            "completed": len(all_latencies),
+            "timed_out": sum(self.timed_out.values()),
+            "expired": sum(self.expired.values()),
+            "failed": sum(sum(failed.values()) for failed in self.failed.values()),
+            "throughput": len(all_latencies) / elapsed,
+            "latency": summarize(all_latencies),
+        }
+        for request_type, latencies in self.latencies.items():
+            report[request_type] = summarize(latencies)
+            report[request_type]["timed_out"] = self.timed_out[request_type]
+            report[request_type]["expired"] = self.expired[request_type]
+            report[request_type]["failed"] = dict(self.failed[request_type])
+        return report
 
-def main_loop():
-    conn = redis.Redis()
 
-    fixtures = build_fixtures()
+def main_loop(args):
+    conn = get_redis_conn()
 
-    for request, audio in fixtures:
-        conn.rpush('queue:requests', json.dumps(request, default=myconverter))
-        conn.set('audio:{}'.format(request['id']), audio)
-        print("Web App pushed {}".format(request['id']))
-        time.sleep(random.randint(1, 4))
+    fixtures = build_fixtures(args.fixtures)
+    generator = LoadGenerator(conn, fixtures, rate=args.rate, duration=args.duration,
+                              register_fraction=args.register_fraction, timeout=args.timeout,
+                              deadline=args.deadline, seed=args.seed)
+    report = generator.run()
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
 
 
 if __name__ == "__main__":
-    gin.external_configurable(redis.Redis, module="redis")
-    gin.parse_config_file("processor/config/prod.gin")
-    main_loop()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=2.0, help="mean arrivals per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to generate arrivals for")
+    parser.add_argument("--register-fraction", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds before a request counts as lost")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="seconds after which the processor drops a request with a timeout result")
+    parser.add_argument("--fixtures", type=str, default="processor/audio_fixtures",
+                        help="directory of wav files, synthesized audio is used if it does not exist")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="also write the report as json")
+    args = parser.parse_args()
 
+    gin.parse_config_file("processor/config/prod.gin", skip_unknown=True)
+    main_loop(args)
@@ -0,0 +1,69 @@
+import numpy as np
+import torch
+
+
+def pad_batch(data_batch, mode='zeros', sort=False):
+    """ Pad variable length utterances into a single (N, L, F) FloatTensor
+
+    The utterances are copied once into a flat buffer and gathered into the batch with
+    one index_select, so no per-utterance padded copies are made.
+
+    :param data_batch: list of (L_i, F) numpy arrays or tensors
+    :param mode: 'zeros' pads with zeros, 'wrap' repeats each utterance up to L
+    :param sort: order the batch by decreasing length (required for packed RNN input)
+    :return: (N, L, F) FloatTensor, list of lengths
+    :raises ValueError: for an empty batch, or an empty utterance in 'wrap' mode
+    """
+    if mode not in ('zeros', 'wrap'):
+        raise ValueError("Invalid mode specified")
+
+    if sort:
+        data_batch = sorted(data_batch, key=lambda s: s.shape[0], reverse=True)
+
+    seq_lens = [len(x) for x in data_batch]
+    if not seq_lens:
+        raise ValueError("Cannot pad an empty batch")
+    if mode == 'wrap' and 0 in seq_lens:
+        raise ValueError("Cannot wrap pad an empty utterance (index {})".format(seq_lens.index(0)))
+    max_len = max(seq_lens)
+    num_feats = data_batch[0].shape[1]
+    total = sum(seq_lens)
+
+    # The extra final row stays zero and is the gather source for zero padding
+    flat = torch.zeros(total + 1, num_feats)
+    offset = 0
+    for x, l in zip(data_batch, seq_lens):
+        flat[offset:offset + l].copy_(torch.as_tensor(x))
+        offset += l
+
+    lens = torch.LongTensor(seq_lens).unsqueeze(1)
+    starts = torch.cumsum(lens, dim=0) - lens
+    steps = torch.arange(max_len, dtype=torch.long).unsqueeze(0)
+    if mode == 'wrap':
+        idxs = starts + steps % lens
+    else:
+        idxs = torch.where(steps < lens, starts + steps, torch.full_like(steps, total))
+
+    seq_batch = torch.empty(len(data_batch) * max_len, num_feats)
+    torch.index_select(flat, 0, idxs.view(-1), out=seq_batch)
+    return seq_batch.view(len(data_batch), max_len, num_feats), seq_lens
+
+
+def length_buckets(seq_lens, max_batch_size=64, max_pad_ratio=1.25):
+    """ Group utterances of similar length so padding waste stays bounded
+
+    Within a bucket the longest utterance is at most max_pad_ratio times the
+    shortest, so at most 1 - 1 / max_pad_ratio of each padded batch is padding.
+
+    :return: list of lists of indices into seq_lens
+    """
+    buckets = []
+    bucket = []
+    for i in np.argsort(seq_lens, kind='stable'):
+        if bucket and (len(bucket) >= max_batch_size or seq_lens[i] > max_pad_ratio * seq_lens[bucket[0]]):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(int(i))
+    if bucket:
+        buckets.append(bucket)
+    return buckets
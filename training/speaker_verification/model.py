@@ -47,13 +47,17 @@ class BasicBlock5x5(nn.Module):
         self.downsample = downsample
         self.stride = stride
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
+        """ mask zeroes the padded frames before the second convolution """
         residual = x
 
         out = self.conv1(x)
         out = self.bn1(out)
         out = self.relu(out)
 
+        if mask is not None:
+            out = out * mask
+
         out = self.conv2(out)
         out = self.bn2(out)
 
@@ -69,8 +73,11 @@ class BasicBlock5x5(nn.Module):
 @gin.configurable
 class IdentifyAndEmbed(nn.Module):
 
-    def __init__(self, nspeakers):
+    def __init__(self, nspeakers, masked=True):
+        """ With masked set, padded frames beyond seq_lens are excluded from every
+        convolution and from the temporal average pool """
         super(IdentifyAndEmbed, self).__init__()
+        self.masked = masked
         self.relu = nn.ReLU()
         self.net = nn.Sequential(
             nn.Conv2d(1, 16, kernel_size=7, stride=(1, 1), padding=(1, 1), bias=False),
@@ -91,6 +98,7 @@ class IdentifyAndEmbed(nn.Module):
         )
 
         self.pool = nn.Sequential(AvgPool(2), Flatten())
+        self.min_frames = self._min_frames()
         self.embedding_size = 256
         self.embedding = nn.Linear(768, self.embedding_size)
         # self.ln = nn.LayerNorm(self.embedding_size)
@@ -103,21 +111,63 @@ class IdentifyAndEmbed(nn.Module):
         #         nn.init.constant_(m.weight, 1)
         #         nn.init.constant_(m.bias, 0)
 
-    def _make_mask(self, utterance_shape, features_shape, seq_lens):
-        _, _, ut, _ = utterance_shape
-        _, _, ft, _ = features_shape
-        scale = ut // ft
-        mask = torch.zeros(features_shape).cuda()
-        for i, l in enumerate(seq_lens):
-            new_length = l // scale
-            mask[i, :, :new_length, :] = 1
-        return mask
+    def _output_lengths(self, lengths, conv):
+        """ Number of valid frames after conv for inputs with lengths valid frames """
+        return (lengths + 2 * conv.padding[0] - conv.dilation[0] * (conv.kernel_size[0] - 1) - 1) // conv.stride[0] + 1
+
+    def _min_frames(self):
+        """ Fewest frames that leave at least one frame after the last convolution """
+        length = 1
+        while True:
+            out = length
+            for layer in self.net:
+                if isinstance(layer, nn.Conv2d):
+                    out = self._output_lengths(out, layer)
+            if out >= 1:
+                return length
+            length += 1
+
+    def _check_lengths(self, x, seq_lens):
+        # Shorter utterances crash the convolutions, or in a padded batch pool over
+        # nothing but padding. Traced exports leave the check to their callers.
+        if torch.jit.is_tracing():
+            return
+        shortest = int(min(seq_lens)) if seq_lens is not None and len(seq_lens) else x.size(2)
+        if shortest < self.min_frames:
+            raise ValueError("Utterance of {} frames is shorter than the {} frames the model "
+                             "needs".format(shortest, self.min_frames))
+
+    def _make_mask(self, x, lengths):
+        """ (N, 1, T, 1) mask of the valid frames of x """
+        steps = torch.arange(x.size(2), device=x.device).view(1, 1, -1, 1)
+        return (steps < lengths.view(-1, 1, 1, 1)).to(x.dtype)
+
+    def _masked_forward(self, x, lengths):
+        """ Run self.net with padded frames zeroed at the input of every convolution,
+        so that valid frames match those of the unpadded utterance, then average
+        pool over the valid frames only """
+        mask = self._make_mask(x, lengths)
+        for layer in self.net:
+            if isinstance(layer, nn.Conv2d):
+                x = layer(x * mask)
+                lengths = self._output_lengths(lengths, layer)
+                mask = self._make_mask(x, lengths)
+            elif isinstance(layer, BasicBlock5x5):
+                x = layer(x * mask, mask)
+            else:
+                x = layer(x)
+        x = (x * mask).sum(dim=2, keepdim=True) / lengths.clamp(min=1).view(-1, 1, 1, 1).to(x.dtype)
+        return x.view(x.size(0), -1)
 
     def forward(self, xs, em=False):
         """ Set em to skip the classification"""
         x, seq_lens = xs
-        out = self.net(x)
-        out = self.pool(out)
+        self._check_lengths(x, seq_lens if self.masked else None)
+        if self.masked and seq_lens is not None:
+            out = self._masked_forward(x, torch.as_tensor(seq_lens, device=x.device))
+        else:
+            out = self.net(x)
+            out = self.pool(out)
         z = self.embedding(out)
         if em:
             return z